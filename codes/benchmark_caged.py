@@ -0,0 +1,121 @@
+# CAGED WORKBOOK READER BENCHMARK
+# Compares the old path of the get_* methods (pd.read_excel of the whole sheet, iloc, dropna, to_numeric, apply) with the
+# streaming reader (get_caged.read_tables), on synthetic workbooks of the real size (3-tabelas.xlsx, ~5,570 municipalities)
+# or on real workbooks of the cache. Each path runs in a new process (time and peak RSS)
+
+import os
+import time
+import random
+from concurrent.futures import ProcessPoolExecutor
+from get_caged import fetch_workbook, read_tables
+
+UFS = ['AC', 'AL', 'AP', 'AM', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MT', 'MS', 'MG', 'PR', 'PB', 'PA', 'PE', 'PI', 'RJ', 'RN', 'RS', 'RO', 'RR', 'SC', 'SE', 'SP', 'TO']
+
+def generate_workbook(path, municipios = 5570, months = 36, seed = 0):
+    # Same layout of the real workbook: title and header lines above each table and notes below it
+    from openpyxl import Workbook
+    rnd = random.Random(seed)
+    wb = Workbook(write_only=True)
+
+    def header(ws, lines):
+        for i in range(lines):
+            ws.append([None, f'Tabela - linha de cabeçalho {i}'])
+
+    ws = wb.create_sheet('Tabela 1')
+    header(ws, 7)
+    for secao in 'ABCDEFGHIJKLMNOPQRSTU':
+        admissoes, desligamentos = rnd.randint(1000, 500000), rnd.randint(1000, 500000)
+        ws.append([None, f'{secao} - Seção {secao}', admissoes, desligamentos, admissoes - desligamentos, rnd.uniform(-5, 5)])
+    ws.append([None, 'Fonte: Novo Caged - SEPRT/ME'])
+
+    ws = wb.create_sheet('Tabela 3')
+    header(ws, 7)
+    for i in range(municipios):
+        uf = rnd.choice(UFS)
+        admissoes, demissoes = rnd.randint(0, 50000), rnd.randint(0, 50000)
+        variacao = rnd.choice([rnd.uniform(-5, 5), '-'])
+        ws.append([None, uf, 1100000 + i, f'{uf}-Município {i}', admissoes, demissoes, admissoes - demissoes, variacao])
+    ws.append([None, 'Fonte: Novo Caged - SEPRT/ME'])
+
+    ws = wb.create_sheet('Tabela 9')
+    header(ws, 5)
+    for i in range(months):
+        ws.append([None, f'{i % 12 + 1:02d}/{2020 + i // 12}', rnd.uniform(1500, 2500), rnd.uniform(1500, 2500)])
+    ws.append([None, 'Fonte: Novo Caged - SEPRT/ME'])
+
+    wb.save(path)
+    return path
+
+def peak_rss():
+    # Peak resident memory of this process in MB (not available on Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def read_excel_tables(path):
+    # The get_* methods before the streaming reader
+    import pandas as pd
+    df = pd.read_excel(path, sheet_name = 'Tabela 3')
+    df = df.iloc[6:, 1:8]
+    df.columns = ['UF', 'CodigoMunicipio' ,'Municipio', 'Admissoes', 'Demissoes', 'Saldo', 'Variacao']
+    df.dropna(inplace=True)
+    df.Admissoes = pd.to_numeric(df.Admissoes)
+    df.Demissoes = pd.to_numeric(df.Demissoes)
+    df.Saldo = pd.to_numeric(df.Saldo)
+    df.Municipio = df.Municipio.apply(lambda x: x[3:])
+    uf_base = df
+
+    df = pd.read_excel(path, sheet_name = 'Tabela 9')
+    df = df.iloc[4:, 1:]
+    df.columns = ['Mes', 'SalarioMedioAdmissao', 'SalarioMedioDesligamento']
+    df.dropna(inplace=True)
+    average_wages = df
+
+    df = pd.read_excel(path, sheet_name = 'Tabela 1')
+    df = df.iloc[6:, 1:6]
+    df.columns = ['Secao', 'Admissoes', 'Desligamentos', 'Saldo', 'Variacao']
+    df.dropna(inplace=True)
+    cnae_section = df
+
+    return {'uf_base': uf_base, 'average_wages': average_wages, 'cnae_section': cnae_section}
+
+READERS = {'read_excel': read_excel_tables, 'streaming': read_tables}
+
+def run_reader(reader, path):
+    start = time.time()
+    tables = READERS[reader](path)
+    seconds = time.time() - start
+    return {'seconds': seconds, 'rows': {name: df.shape[0] for name, df in tables.items()}, 'peak_rss_mb': peak_rss()}
+
+def benchmark(paths, readers = None, repeat = 3):
+    # Best of repeat runs of each reader on each workbook, rows of every table must match between readers
+    results = []
+    for path in paths:
+        rows = None
+        for reader in readers or READERS:
+            runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    runs.append(executor.submit(run_reader, reader, path).result())
+            result = min(runs, key=lambda x: x['seconds'])
+            result.update({'file': path, 'reader': reader})
+            print(result)
+            if rows is not None and rows != result['rows']:
+                print(f'Rows differ from the previous reader: {rows}')
+            rows = result['rows']
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    # Set Global Variables
+    FOLDER = 'bench_caged'
+    # Real workbooks of the cache, downloaded if needed
+    REAL = [] # ['Jul2022', 'Dec2021']
+
+    os.makedirs(FOLDER, exist_ok=True)
+    paths = [generate_workbook(os.path.join(FOLDER, 'synthetic-3-tabelas.xlsx'))]
+    paths += [fetch_workbook(dtCut) for dtCut in REAL]
+    benchmark(paths)
@@ -0,0 +1,228 @@
+# SYNTHETIC RECEITA FEDERAL CNPJ FILES AND LOADER BENCHMARK
+# Generates zips in the same format of the Receita Federal files (ISO-8859-1, ';' delimited, quoted fields, '00000000' dates)
+# for every model of LAYOUT_FILES, and measures each stage of the load separately (rows/s and peak RSS)
+
+import io
+import os
+import csv
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from get_cnpj_receita_federal import LAYOUT_FILES, UFS, INTEGER_TYPES, DB_CNPJ, LoadMetrics, get_model, read_zip_chunks, format_chunk, upload_zip_file, upload_zip_file_elt, \
+                                     binary_copy_data
+
+WORDS = ['COMERCIO', 'SERVIÇOS', 'INDÚSTRIA', 'CONSTRUÇÃO', 'LTDA', 'ME', 'EIRELI', 'JOÃO', 'JOSÉ', 'MARIA', 'SÃO', 'PAULO', 'AÇAÍ',
+         'PADARIA', 'MERCADO', 'TRANSPORTES', 'ASSOCIAÇÃO', 'CONDOMÍNIO', 'ÓTICA', 'FARMÁCIA']
+
+# Name of the zip of each model, as in the server (Estabelecimentos0.zip, Municipios.zip...)
+FILE_NAMES = {'EMPRESAS': 'Empresas0.zip', 'ESTABELECIMENTOS': 'Estabelecimentos0.zip', 'SIMPLES': 'Simples.zip', 'SOCIOS': 'Socios0.zip',
+              'PAISES': 'Paises.zip', 'MUNICIPIOS': 'Municipios.zip', 'QUALIFICACOES': 'Qualificacoes.zip', 'NATUREZAS': 'Naturezas.zip',
+              'MOTIVOS': 'Motivos.zip', 'CNAES': 'Cnaes.zip'}
+
+def fake_column(rng, column, sql_type, rows):
+    # rows random values of a column as text (arrow array), generated a whole column at a time
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    def text(values, width = 1):
+        return pc.utf8_lpad(pa.array(values).cast(pa.string()), width=width, padding='0')
+
+    def choice(options):
+        return pa.array(options, pa.string()).take(rng.integers(0, len(options), rows))
+
+    def join(parts, counts, sep):
+        # Row i gets the first counts[i] parts joined with sep
+        result = pa.array([''] * rows, pa.string())
+        for k, part in enumerate(parts):
+            result = pc.if_else(counts > k, pc.binary_join_element_wise(result, part, sep if k else ''), result)
+        return result
+
+    if sql_type == 'date':
+        # Real files have many empty dates written as '00000000' or '0', and a few impossible ones
+        dates = text(rng.integers(1960, 2023, rows) * 10000 + rng.integers(1, 13, rows) * 100 + rng.integers(1, 29, rows))
+        return pc.if_else(rng.integers(0, 5, rows) >= 3, dates, choice(['00000000', '0', '', '00000000', '0', '', '20220230', '20221301']))
+    if sql_type == 'char(8)':
+        return text(rng.integers(0, 100000000, rows), 8)
+    if sql_type == 'char(4)':
+        return text(rng.integers(1, 21, rows), 4)
+    if sql_type == 'char(2)':
+        return choice(UFS) if column == 'st_uf' else text(rng.integers(0, 100, rows), 2)
+    if sql_type == 'char(1)':
+        return choice(['S', 'N', ''])
+    if sql_type in INTEGER_TYPES:
+        # Codes come with leading zeros
+        return text(rng.integers(1, (9999 if sql_type == 'smallint' else 9999999) + 1, rows), 2)
+    if sql_type.startswith('numeric'):
+        return pc.binary_join_element_wise(text(rng.integers(0, 10000001, rows)), text(rng.integers(0, 100, rows), 2), ',')
+    counts = rng.integers(0, 5, rows)
+    if column == 'cd_cnae_secundario':
+        return join([text(rng.integers(1000000, 10000000, rows)) for _ in range(4)], counts, ',')
+    return join([choice(WORDS) for _ in range(4)], counts, ' ')
+
+def generate_file(model, rows, folder = '.', seed = 0, part = 0, block = 100000):
+    # Write a zip with rows random rows of model, block rows at a time, returns its path
+    # part: number of the file for the models split in several zips (Estabelecimentos0.zip, Estabelecimentos1.zip...)
+    # Lines are built by arrow (every field quoted, ';' delimited); the zip is written with fast compression
+    import numpy as np
+    import pyarrow.compute as pc
+    rng = np.random.default_rng([seed, part])
+    columns = LAYOUT_FILES[model]['columns']
+    path = os.path.join(folder, FILE_NAMES[model].replace('0.zip', f'{part}.zip'))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zip_ref:
+        with zip_ref.open(f'K3241.K03200Y0.D21009.{model[:8]}', 'w', force_zip64=True) as member:
+            for start in range(0, rows, block):
+                n = min(block, rows - start)
+                fields = [fake_column(rng, c, t, n) for c, t in columns.items()]
+                lines = pc.binary_join_element_wise('"', pc.binary_join_element_wise(*fields, '";"'), '"\n', '')
+                member.write(''.join(lines.to_pylist()).encode('ISO-8859-1'))
+    return path
+
+def generate_files(rows, folder = '.', models = None, seed = 0, workers = None, part_rows = 10000000):
+    # Lookup tables (PAISES, MUNICIPIOS...) are small in the real base, so they get at most 10,000 rows.
+    # The models split in several zips in the server (Empresas0.zip...) get one zip per part_rows rows.
+    # Each zip is written by its own process (workers = None: one per core)
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for model in models or LAYOUT_FILES:
+        n = rows if model in ['EMPRESAS', 'ESTABELECIMENTOS', 'SIMPLES', 'SOCIOS'] else min(rows, 10000)
+        if not FILE_NAMES[model].endswith('0.zip'):
+            files.append((model, n, 0))
+            continue
+        files += [(model, min(part_rows, n - start), part) for part, start in enumerate(range(0, n, part_rows))]
+
+    paths = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(generate_file, model, n, folder, seed, part) for model, n, part in files]
+        for future, (model, n, part) in zip(futures, files):
+            paths.append(future.result())
+            print(f'{paths[-1]} generated with {n} rows')
+    return paths
+
+def peak_rss():
+    # Peak resident memory of this process in MB (not available on Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def stage_unzip(file, *_):
+    start = time.time()
+    size = 0
+    with zipfile.ZipFile(file, 'r') as zip_ref:
+        with zip_ref.open(zip_ref.namelist()[0], 'r') as member:
+            for block in iter(lambda: member.read(1024 * 1024), b''):
+                size += len(block)
+    return {'bytes': size, 'seconds': time.time() - start}
+
+def stage_parse(file, *_):
+    layout = LAYOUT_FILES[get_model(file)]
+    start = time.time()
+    rows = 0
+    for chunk in read_zip_chunks(file, layout['columns'].keys()):
+        rows += chunk.shape[0]
+    return {'rows': rows, 'seconds': time.time() - start}
+
+def stage_format(file, *_):
+    # Only the conversion of the parsed chunks is timed (dates, codes and values)
+    layout = LAYOUT_FILES[get_model(file)]
+    seconds = 0
+    rows = 0
+    for chunk in read_zip_chunks(file, layout['columns'].keys()):
+        start = time.time()
+        format_chunk(chunk, layout)
+        seconds += time.time() - start
+        rows += chunk.shape[0]
+    return {'rows': rows, 'seconds': seconds}
+
+def stage_encode(file, *_):
+    # Only the csv encoding done by psql_insert_copy before the COPY is timed
+    layout = LAYOUT_FILES[get_model(file)]
+    seconds = 0
+    rows = 0
+    size = 0
+    for chunk in read_zip_chunks(file, layout['columns'].keys()):
+        format_chunk(chunk, layout)
+        start = time.time()
+        s_buf = io.StringIO()
+        csv.writer(s_buf).writerows(chunk.itertuples(index=False, name=None))
+        seconds += time.time() - start
+        rows += chunk.shape[0]
+        size += s_buf.tell()
+    return {'rows': rows, 'bytes': size, 'seconds': seconds}
+
+def stage_encode_binary(file, *_):
+    # Only the binary encoding done by copy_binary before the COPY is timed
+    layout = LAYOUT_FILES[get_model(file)]
+    types = list(layout['columns'].values())
+    seconds = 0
+    rows = 0
+    size = 0
+    for chunk in read_zip_chunks(file, layout['columns'].keys()):
+        format_chunk(chunk, layout)
+        start = time.time()
+        for data in binary_copy_data(chunk, types):
+            size += len(data)
+        seconds += time.time() - start
+        rows += chunk.shape[0]
+    return {'rows': rows, 'bytes': size, 'seconds': seconds}
+
+def stage_copy(file, db, loader):
+    # Whole load of the file into a local Postgres, table recreated before. Only the time of the COPY recorded by the loader
+    # is reported as seconds (the ELT staging COPY plus its INSERT ... SELECT), the parse and format of the chunks are the other stages
+    obj = DB_CNPJ(db['user'], db['password'], db['ip_postgres'], db['schema'], offline=True)
+    obj.get_engine().execute(f'CREATE SCHEMA IF NOT EXISTS {db["schema"]}')
+    obj.create_table(file)
+    metrics = LoadMetrics()
+    start = time.time()
+    if loader == 'elt':
+        rows = upload_zip_file_elt(obj.engine, file, LAYOUT_FILES[get_model(file)], metrics=metrics)
+        copy_stages = ['staging_copy', 'transform']
+    else:
+        rows = upload_zip_file(obj.engine, file, LAYOUT_FILES[get_model(file)], metrics=metrics, copy_format='binary' if loader == 'binary' else 'csv')
+        copy_stages = ['copy']
+    seconds = sum(metrics.totals[s]['seconds'] for s in copy_stages if s in metrics.totals)
+    return {'rows': rows, 'seconds': seconds, 'wall_seconds': time.time() - start}
+
+STAGES = {'unzip': (stage_unzip, None), 'parse': (stage_parse, None), 'format': (stage_format, None), 'encode': (stage_encode, None),
+          'encode_binary': (stage_encode_binary, None), 'copy_pandas': (stage_copy, 'pandas'), 'copy_binary': (stage_copy, 'binary'),
+          'copy_elt': (stage_copy, 'elt')}
+
+def run_stage(stage, file, db):
+    function, loader = STAGES[stage]
+    result = function(file, db, loader)
+    result['peak_rss_mb'] = peak_rss()
+    return result
+
+def benchmark(files, stages = None, db = None):
+    # Each stage runs in a new process, so its peak RSS isn't mixed with the other stages
+    # db: {'user', 'password', 'ip_postgres', 'schema'} of a local Postgres, the copy stages are skipped without it
+    if stages is None:
+        stages = [s for s in STAGES if db is not None or not s.startswith('copy')]
+
+    results = []
+    for file in files:
+        for stage in stages:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_stage, stage, file, db).result()
+            result.update({'file': file, 'stage': stage})
+            if 'rows' in result:
+                result['rows_s'] = result['rows'] / max(result['seconds'], 1e-9)
+            if 'bytes' in result:
+                result['mb_s'] = result['bytes'] / 1024 / 1024 / max(result['seconds'], 1e-9)
+            print(result)
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    # Set Global Variables
+    ROWS = 1000000
+    FOLDER = 'bench_cnpj'
+    # Local Postgres for the copy stages, None to skip them
+    DB = None # {'user': 'postgres', 'password': 'postgres', 'ip_postgres': 'localhost:5432', 'schema': 'cnpj_bench'}
+
+    paths = generate_files(ROWS, FOLDER, models=['ESTABELECIMENTOS', 'EMPRESAS', 'SOCIOS', 'SIMPLES'])
+    # Loader reads the zips from the working folder
+    os.chdir(FOLDER)
+    benchmark([os.path.basename(p) for p in paths], db=DB)
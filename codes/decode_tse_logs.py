@@ -0,0 +1,173 @@
+# DECODER OF THE TSE 2022 BALLOT BOX LOGS DOWNLOADED BY download_tse_2022.py
+# Each .logjez is a 7z archive with the log of the ballot box (logd.dat): one event per line, tab separated
+# (date time, level, ballot box id, application, message, hash of the line), in ISO-8859-1.
+# The logs of the sections are read from the storage of the download (tse_storage), decompressed in memory by a process pool and written as parquet under
+# folder/cd_uf=XX/cd_municipio=NNNNN/, each file sorted by zone and section. Partition values are text (read them back with a
+# string partitioning schema, see __main__). Decoded files are recorded in the manifest
+# of the download, so a new run only decodes the sections downloaded since the last one.
+# py7zr and pyarrow are imported only by the workers
+
+import io
+import os
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from download_tse_2022 import open_manifest
+from tse_storage import FolderStorage
+
+LOG_EXTENSION = '.logjez'
+
+MANIFEST_TABLES = '''
+CREATE TABLE IF NOT EXISTS tb_log (cd_uf TEXT, cd_municipio TEXT, cd_zona TEXT, cd_secao TEXT, nm_arquivo TEXT, nm_parquet TEXT, nr_eventos INTEGER,
+                                   PRIMARY KEY (cd_uf, cd_municipio, cd_zona, cd_secao, nm_arquivo));
+'''
+
+# Columns of the event dataset, partition columns (cd_uf, cd_municipio) are in the folder names
+EVENT_COLUMNS = ['cd_zona', 'cd_secao', 'nr_linha', 'dt_evento', 'st_nivel', 'cd_urna', 'st_aplicacao', 'st_mensagem', 'st_hash']
+
+def read_log(data):
+    # Text of the log inside a .logjez (bytes)
+    # py7zr >= 1.0: members are extracted to memory through a BytesIOFactory, limited to the size of the member
+    import py7zr
+    import py7zr.io
+    with py7zr.SevenZipFile(io.BytesIO(data), 'r') as archive:
+        names = archive.namelist()
+        name = 'logd.dat' if 'logd.dat' in names else sorted(names)[0]
+        factory = py7zr.io.BytesIOFactory(archive.getinfo(name).uncompressed)
+        archive.extract(targets=[name], factory=factory)
+    member = factory.get(name)
+    member.seek(0)
+    return member.read().decode('ISO-8859-1')
+
+def parse_log(text):
+    # Split the lines of a log in columns (lists of strings), malformed lines are padded with None
+    columns = [[] for _ in range(6)]
+    for line in text.splitlines():
+        if not line:
+            continue
+        fields = line.split('\t', 5)
+        fields += [None] * (6 - len(fields))
+        for column, value in zip(columns, fields):
+            column.append(value)
+    return columns
+
+def events_table(sections):
+    # sections: list of (cd_zona, cd_secao, text of the log). Types are converted by arrow, column by column
+    # Returns the table and the number of events of each log
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    data = {c: [] for c in EVENT_COLUMNS}
+    counts = []
+    for cd_zona, cd_secao, text in sections:
+        dt, level, urna, app, message, line_hash = parse_log(text)
+        counts.append(len(dt))
+        data['cd_zona'] += [cd_zona] * len(dt)
+        data['cd_secao'] += [cd_secao] * len(dt)
+        data['nr_linha'] += range(1, len(dt) + 1)
+        data['dt_evento'] += dt
+        data['st_nivel'] += level
+        data['cd_urna'] += urna
+        data['st_aplicacao'] += app
+        data['st_mensagem'] += message
+        data['st_hash'] += line_hash
+
+    urna = pa.array(data['cd_urna'], pa.string())
+    table = pa.table({
+        'cd_zona': pa.array(data['cd_zona'], pa.string()).dictionary_encode(),
+        'cd_secao': pa.array(data['cd_secao'], pa.string()),
+        'nr_linha': pa.array(data['nr_linha'], pa.int32()),
+        'dt_evento': pc.strptime(pa.array(data['dt_evento'], pa.string()), format='%d/%m/%Y %H:%M:%S', unit='s', error_is_null=True),
+        'st_nivel': pa.array(data['st_nivel'], pa.string()).dictionary_encode(),
+        # Ids of the ballot boxes have 8 digits, anything else becomes null
+        'cd_urna': pc.if_else(pc.utf8_is_digit(urna), urna, pa.scalar(None, pa.string())).cast(pa.int32()),
+        'st_aplicacao': pa.array(data['st_aplicacao'], pa.string()).dictionary_encode(),
+        'st_mensagem': pa.array(data['st_mensagem'], pa.string()),
+        'st_hash': pa.array(data['st_hash'], pa.string()),
+    })
+    return table, counts
+
+def read_stored_log(storage, key, nm_arquivo):
+    data = storage.get(key, nm_arquivo)
+    if data is None:
+        raise IOError('{} of section {} not found in storage'.format(nm_arquivo, key))
+    return read_log(data)
+
+def decode_batch(storage, output, batch):
+    # Decode the logs of a batch of sections of one municipality into one parquet file.
+    # The name of the file comes from its content, so a batch decoded again (run stopped before the manifest was updated) overwrites it
+    import pyarrow.parquet as pq
+
+    cd_uf, cd_municipio = batch[0][0], batch[0][1]
+    batch = sorted(batch, key=lambda x: (x[2], x[3], x[4]))
+    sections = [(key[2], key[3], read_stored_log(storage, key[:4], key[4])) for key in batch]
+    table, counts = events_table(sections)
+
+    path = os.path.join(output, f'cd_uf={cd_uf}', f'cd_municipio={cd_municipio}')
+    os.makedirs(path, exist_ok=True)
+    name = 'part-{}.parquet'.format(hashlib.sha1(repr(batch).encode()).hexdigest()[:16])
+    pq.write_table(table, os.path.join(path, name + '.tmp'), compression='zstd', row_group_size=1000000)
+    os.replace(os.path.join(path, name + '.tmp'), os.path.join(path, name))
+    return [(*key, name, count) for key, count in zip(batch, counts)]
+
+def pending_logs(conn):
+    # Logs downloaded and not decoded yet, by municipality
+    rows = conn.execute(f'''SELECT a.cd_uf, a.cd_municipio, a.cd_zona, a.cd_secao, a.nm_arquivo FROM tb_arquivo a
+                            LEFT JOIN tb_log l ON l.cd_uf = a.cd_uf AND l.cd_municipio = a.cd_municipio AND l.cd_zona = a.cd_zona
+                                              AND l.cd_secao = a.cd_secao AND l.nm_arquivo = a.nm_arquivo
+                            WHERE a.status = 'done' AND a.nm_arquivo LIKE '%{LOG_EXTENSION}' AND l.nm_arquivo IS NULL
+                            ORDER BY a.cd_uf, a.cd_municipio, a.cd_zona, a.cd_secao''')
+    municipios = {}
+    for row in rows:
+        municipios.setdefault((row[0], row[1]), []).append(row)
+    return municipios
+
+def decode_logs(folder_path, storage = None, output = None, workers = None, batch_size = 200):
+    # Decode all the logs downloaded and not decoded yet, with one process per core (workers = None).
+    # Each task is up to batch_size sections of one municipality, written as one parquet file
+    # storage: the same of the download, FolderStorage(folder_path) by default
+    storage = storage if storage is not None else FolderStorage(folder_path)
+    output = output if output is not None else os.path.join(folder_path, 'logs')
+    conn = open_manifest(folder_path)
+    conn.executescript(MANIFEST_TABLES)
+
+    batches = []
+    for rows in pending_logs(conn).values():
+        batches += [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+
+    start = time.time()
+    files = 0
+    events = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(decode_batch, storage, output, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                decoded = future.result()
+            except Exception as e:
+                batch = futures[future]
+                print('Error decoding {} {} ({} sections): {}'.format(batch[0][0], batch[0][1], len(batch), e))
+                continue
+            # Manifest is only written by this process, one transaction per batch
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO tb_log VALUES (?, ?, ?, ?, ?, ?, ?)', decoded)
+            files += len(decoded)
+            events += sum(d[-1] for d in decoded)
+            print('{} logs, {} events, {:.1f} logs/s'.format(files, events, files / max(time.time() - start, 1e-9)))
+
+    conn.close()
+    return events
+
+
+if __name__ == '__main__':
+    # Same folder used by download_tse_2022.py
+    folder_path = 'C:/tse_analise/'
+    decode_logs(folder_path)
+    # from tse_storage import PackStorage
+    # decode_logs(folder_path, PackStorage(folder_path + 'packs'))
+
+    # Read one UF back. The partition columns are text, as in the manifest: inferred by 'hive' alone cd_municipio
+    # would become an integer and lose its leading zeros (01120 -> 1120)
+    # import pyarrow as pa
+    # import pyarrow.dataset as ds
+    # partitioning = ds.partitioning(pa.schema([('cd_uf', pa.string()), ('cd_municipio', pa.string())]), flavor='hive')
+    # ds.dataset(folder_path + 'logs', partitioning=partitioning).to_table(filter=ds.field('cd_uf') == 'pe').to_pandas()
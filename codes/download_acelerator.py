@@ -1,62 +1,327 @@
 import os
+import json
 import time
-import shutil
 import threading
-import requests
+import http_client
 from urllib import parse
 
-url = 'http://200.152.38.155/CNPJ/Simples.zip'
-conns = 8
-tmp_dir = 'C:/Users/neymo/OneDrive/Git/public/codes/tmp/'
-dl_dir = 'C:/Users/neymo/OneDrive/Git/public/codes/'
-
 def get_filename_from_url(url):
 	return parse.urlsplit(url).path.split('/')[-1]
 
-def download(url, start, this_chunk_size, part):
-	r = requests.get(url, headers={'Range':'bytes=%d-%d' % (start, start + this_chunk_size-1)}, stream=True)
-	filename = get_filename_from_url(url) + '_%d' % part
-	filepath = os.path.join(tmp_dir, filename)
-	print('Downloading %s' % filepath)
-	with open(filepath, 'wb') as f:
-		for chunk in r.iter_content(chunk_size=1024):
-			if chunk:
-				f.write(chunk)
-	print('Downloaded %s' % filepath)
-
-# check if URL accept ranges
-r = requests.head(url)
-accept_ranges = 'accept-ranges' in r.headers and 'bytes' in r.headers['accept-ranges']
-if not accept_ranges:
-	print('URL does not accept byte ranges.')
-	quit()
-
-# download chunks
-size = int(r.headers['content-length'])
-chunk_size = int((size / conns))
-remainder = 0 if size - (chunk_size * conns) <= 0 else size - (chunk_size * conns)
-threads = []
-for start in range(0, size, chunk_size):
-	part = len(threads)
-	this_chunk_size = chunk_size if part != conns-1 else chunk_size + remainder
-	t = threading.Thread(target=download, args=(url, start, this_chunk_size, part))
-	threads.append(t)
-	t.daemon = True
-	t.start()
-
-# merge into a single file
-while threading.active_count() > 1:
-	time.sleep(0.1)
-
-print('All parts downloaded. Joining files...')
-
-filename = get_filename_from_url(url)
-filepath = os.path.join(dl_dir, filename)
-with open(filepath, 'wb') as f:
-	for i in range(conns):
-		tmp_filename = filename + '_%d' % i
-		tmp_filepath = os.path.join(tmp_dir, tmp_filename)
-		shutil.copyfileobj(open(tmp_filepath, 'rb'), f)
-		os.remove(tmp_filepath)
-
-print('Joining complete. File saved in %s' % filepath)
+class Segment:
+	# Byte range [start, end) of the file, pos is the next byte to download
+	def __init__(self, start, end):
+		self.start = start
+		self.pos = start
+		self.end = end
+
+class RangedDownloader:
+	# Download a file with several connections, each one writing its byte range directly at its offset of the
+	# preallocated destination file (no part files and no join at the end).
+	# Completed ranges are kept in a sidecar file (dest_file + '.ranges'), so an interrupted download resumes where it stopped.
+	# A connection that finishes its range takes half of the biggest range still downloading.
+	# adaptive = True: throughput is measured every interval seconds and connections are added or dropped
+	# (between min_conns and max_conns) while it improves, conns is only the starting point
+	def __init__(self, url, dest_file = None, conns = 8, buffer_size = 1024 * 1024, min_split = 4 * 1024 * 1024, max_retries = 5,
+				 adaptive = False, min_conns = 1, max_conns = 32, interval = 2.0):
+		self.url = url
+		self.dest_file = dest_file if dest_file is not None else get_filename_from_url(url)
+		self.sidecar_file = self.dest_file + '.ranges'
+		self.conns = conns
+		self.adaptive = adaptive
+		self.min_conns = min_conns
+		self.max_conns = max_conns
+		self.interval = interval
+		self.target_conns = conns
+		self.running = 0
+		self.threads = []
+		# Bytes downloaded in this run, in total and by connection (thread name), and the speed of each connection in the last interval
+		self.downloaded = 0
+		self.conn_bytes = {}
+		self.conn_rates = {}
+		# Connections picked to stop when the target is lowered
+		self.dropping = set()
+		self.buffer_size = buffer_size
+		# Ranges smaller than this aren't split between connections
+		self.min_split = min_split
+		self.max_retries = max_retries
+		self.lock = threading.Lock()
+		self.size = None
+		self.completed = []
+		self.pending = []
+		self.active = []
+		self.errors = 0
+		self.last_save = 0
+
+	def get_size(self):
+		# Size of the file and if the server accepts byte ranges
+		r = http_client.head(self.url, allow_redirects=True)
+		accept_ranges = 'bytes' in r.headers.get('accept-ranges', '')
+		return int(r.headers['content-length']), accept_ranges
+
+	def load_sidecar(self):
+		if not os.path.exists(self.sidecar_file) or not os.path.exists(self.dest_file):
+			return []
+		with open(self.sidecar_file, 'r') as f:
+			sidecar = json.load(f)
+		# Another file (or another version of it), start again
+		if sidecar['url'] != self.url or sidecar['size'] != self.size:
+			return []
+		return [tuple(r) for r in sidecar['completed']]
+
+	def save_sidecar(self, force = False):
+		# Called with the lock held, written at most once per second
+		if not force and time.time() - self.last_save < 1:
+			return
+		with open(self.sidecar_file + '.tmp', 'w') as f:
+			json.dump({'url': self.url, 'size': self.size, 'completed': self.completed}, f)
+		os.replace(self.sidecar_file + '.tmp', self.sidecar_file)
+		self.last_save = time.time()
+
+	def mark_completed(self, start, end):
+		# Add [start, end) to the completed ranges, merging neighbours
+		ranges = sorted(self.completed + [(start, end)])
+		merged = [ranges[0]]
+		for s, e in ranges[1:]:
+			if s <= merged[-1][1]:
+				merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+			else:
+				merged.append((s, e))
+		self.completed = merged
+
+	def missing_ranges(self):
+		missing = []
+		pos = 0
+		for s, e in self.completed:
+			if s > pos:
+				missing.append((pos, s))
+			pos = max(pos, e)
+		if pos < self.size:
+			missing.append((pos, self.size))
+		return missing
+
+	def split_ranges(self, ranges):
+		# Split the missing ranges in about conns segments of similar size
+		total = sum(e - s for s, e in ranges)
+		target = max(total // self.conns, 1)
+		segments = []
+		for s, e in ranges:
+			while e - s > target + self.min_split:
+				segments.append(Segment(s, s + target))
+				s += target
+			segments.append(Segment(s, e))
+		return segments
+
+	def next_segment(self):
+		# A segment not started yet, or half of the biggest segment still downloading (work stealing)
+		with self.lock:
+			if self.pending:
+				segment = self.pending.pop(0)
+				self.active.append(segment)
+				return segment
+			if self.active:
+				victim = max(self.active, key=lambda x: x.end - x.pos)
+				remaining = victim.end - victim.pos
+				# Near the end the ranges are split in smaller units, so all connections finish at about the same time
+				left = sum(x.end - x.pos for x in self.active)
+				min_split = max(self.buffer_size, min(self.min_split, left // (2 * max(self.running, 1))))
+				if remaining >= 2 * min_split:
+					middle = victim.pos + remaining // 2
+					segment = Segment(middle, victim.end)
+					victim.end = middle
+					self.active.append(segment)
+					return segment
+		return None
+
+	def should_stop(self):
+		# Called with the lock held, a connection stops when there are more running than target_conns.
+		# The slowest ones are picked by set_target, any connection stops if none of them is still running
+		name = threading.current_thread().name
+		if self.running > self.target_conns and (name in self.dropping or not self.dropping):
+			self.dropping.discard(name)
+			self.running -= 1
+			return True
+		return False
+
+	def write(self, f, start, data):
+		f.seek(start)
+		f.write(data)
+		with self.lock:
+			self.mark_completed(start, start + len(data))
+			self.save_sidecar()
+
+	def download_segment(self, segment, f):
+		# Returns False when the connection was dropped before the end of the segment
+		# Data is read in small blocks (so throughput is measured smoothly) and written in blocks of buffer_size
+		name = threading.current_thread().name
+		r = http_client.get(self.url, headers={'Range': 'bytes=%d-%d' % (segment.pos, segment.end - 1)}, stream=True)
+		buffer = bytearray()
+		buffer_start = segment.pos
+		try:
+			# Without byte ranges only the whole file can be downloaded
+			whole_file = r.status_code == 200 and segment.pos == 0 and segment.end == self.size
+			if r.status_code != 206 and not whole_file:
+				raise IOError('Range request returned HTTP %d' % r.status_code)
+			for chunk in r.iter_content(chunk_size=64 * 1024):
+				with self.lock:
+					# end can shrink while downloading, when another connection takes part of this segment
+					chunk = chunk[:max(segment.end - segment.pos, 0)]
+					segment.pos += len(chunk)
+					self.downloaded += len(chunk)
+					self.conn_bytes[name] = self.conn_bytes.get(name, 0) + len(chunk)
+					done = segment.pos >= segment.end
+					stop = not done and self.should_stop()
+				buffer += chunk
+				if len(buffer) >= self.buffer_size:
+					self.write(f, buffer_start, buffer)
+					buffer_start += len(buffer)
+					buffer = bytearray()
+				if done:
+					break
+				if stop:
+					return False
+		finally:
+			r.close()
+			# Bytes already received are always written, segment.pos counts them
+			if buffer:
+				self.write(f, buffer_start, buffer)
+		return True
+
+	def worker(self):
+		try:
+			self.run_worker()
+		finally:
+			with self.lock:
+				self.dropping.discard(threading.current_thread().name)
+
+	def run_worker(self):
+		# Each connection has its own handle of the destination file, so writes at different offsets don't interfere
+		with open(self.dest_file, 'r+b', buffering=0) as f:
+			while True:
+				with self.lock:
+					if self.should_stop():
+						return
+				segment = self.next_segment()
+				if segment is None:
+					with self.lock:
+						self.running -= 1
+					return
+				stopped = False
+				try:
+					stopped = not self.download_segment(segment, f)
+				except Exception as e:
+					with self.lock:
+						self.errors += 1
+						if self.errors > self.max_retries:
+							self.running -= 1
+							raise
+						print('Error downloading %s (%s), retrying range %d-%d' % (self.url, e, segment.pos, segment.end))
+				finally:
+					with self.lock:
+						self.active.remove(segment)
+						# What is left of the segment goes back to the queue
+						if segment.pos < segment.end:
+							self.pending.append(Segment(segment.pos, segment.end))
+				if stopped:
+					return
+
+	def start_worker(self):
+		with self.lock:
+			self.running += 1
+		t = threading.Thread(target=self.worker, daemon=True)
+		self.threads.append(t)
+		t.start()
+
+	def set_target(self, target):
+		target = min(max(target, self.min_conns), self.max_conns)
+		with self.lock:
+			self.target_conns = target
+			start = max(target - self.running, 0)
+			# Slowest connections of the last interval are the ones dropped
+			self.dropping = set(sorted(self.conn_rates, key=self.conn_rates.get)[:max(self.running - target, 0)])
+		for _ in range(start):
+			self.start_worker()
+
+	def tune(self, rate):
+		# Hill climbing on the number of connections, each change is compared with the throughput before it:
+		# a connection is added while it brings 5% more throughput and dropped while that costs less than 5%.
+		# A change that didn't pay is undone and the count is held for a few intervals before probing again
+		if self.hold > 0:
+			self.hold -= 1
+			return
+		if self.base_rate is None:
+			self.base_rate = rate
+			self.set_target(self.target_conns + self.direction)
+			return
+		if (self.direction > 0 and rate >= self.base_rate * 1.05) or (self.direction < 0 and rate >= self.base_rate * 0.95):
+			self.base_rate = rate
+			self.set_target(self.target_conns + self.direction)
+		else:
+			self.set_target(self.target_conns - self.direction)
+			self.direction = -self.direction
+			self.base_rate = None
+			self.hold = 3
+
+	def download(self):
+		self.size, accept_ranges = self.get_size()
+		if not accept_ranges:
+			print('URL does not accept byte ranges, using a single connection.')
+			self.conns = 1
+			self.min_split = self.size + 1
+
+		self.completed = self.load_sidecar() if accept_ranges else []
+		if self.completed:
+			print('Resuming %s, %d of %d bytes already downloaded' % (self.dest_file, sum(e - s for s, e in self.completed), self.size))
+		else:
+			# Preallocate the destination file
+			with open(self.dest_file, 'wb') as f:
+				f.truncate(self.size)
+			with self.lock:
+				self.save_sidecar(force=True)
+
+		self.pending = self.split_ranges(self.missing_ranges())
+		self.target_conns = min(self.conns, max(len(self.pending), 1))
+		# Each connection streams its range, so the pool of the host must hold all of them
+		http_client.reserve_connections(self.url, max(self.conns, self.max_conns) if self.adaptive else self.conns)
+		for _ in range(self.target_conns):
+			self.start_worker()
+
+		# Throughput is measured every interval until all connections finish
+		last_bytes = 0
+		last_conn_bytes = {}
+		self.direction, self.base_rate, self.hold = 1, None, 0
+		while any(t.is_alive() for t in self.threads):
+			start = time.time()
+			while time.time() - start < self.interval and any(t.is_alive() for t in self.threads):
+				time.sleep(0.05)
+			alive = set(t.name for t in self.threads if t.is_alive())
+			with self.lock:
+				elapsed = time.time() - start
+				rate = (self.downloaded - last_bytes) / elapsed
+				last_bytes = self.downloaded
+				self.conn_rates = {name: (self.conn_bytes.get(name, 0) - last_conn_bytes.get(name, 0)) / elapsed for name in alive}
+				last_conn_bytes = dict(self.conn_bytes)
+				running = self.running
+			rates = self.conn_rates.values() or [0]
+			print('%d connections, %.2f MB/s (%.2f to %.2f MB/s per connection)' % (running, rate / 1024 / 1024, min(rates) / 1024 / 1024, max(rates) / 1024 / 1024))
+			# Near the end there is not enough work for every connection, so throughput no longer means anything
+			with self.lock:
+				enough_work = sum(x.end - x.pos for x in self.pending + self.active) > self.min_split * max(running, 1)
+			if self.adaptive and running > 0 and enough_work:
+				self.tune(rate)
+
+		with self.lock:
+			self.save_sidecar(force=True)
+			if self.missing_ranges():
+				raise IOError('Download of %s incomplete, run again to resume' % self.url)
+		os.remove(self.sidecar_file)
+		print('Download complete. File saved in %s' % self.dest_file)
+		return self.dest_file
+
+
+if __name__ == '__main__':
+	url = 'http://200.152.38.155/CNPJ/Simples.zip'
+	conns = 8
+	dl_dir = 'C:/Users/neymo/OneDrive/Git/public/codes/'
+
+	RangedDownloader(url, os.path.join(dl_dir, get_filename_from_url(url)), conns, adaptive=True).download()
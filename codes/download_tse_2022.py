@@ -1,73 +1,273 @@
-import requests
-import pandas as pd
-from time import sleep
 import os
+import json
+import hashlib
+import time
+import sqlite3
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+from tse_storage import FolderStorage
 
-header = {'user-agent' :'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36'}
+URL_BASE = 'https://resultados.tse.jus.br/oficial/ele2022/arquivo-urna/407/'
+UFS = ['ac', 'al', 'ap', 'am', 'ba', 'ce', 'df', 'es', 'zz', 'go', 'ma', 'mt', 'ms', 'mg', 'pr', 'pb', 'pa', 'pe', 'pi', 'rj', 'rn', 'rs', 'ro', 'rr', 'sc', 'se', 'sp', 'to']
 
-# Downloading base from URL, using requests
-def download_file(url : str, dest_file : str):
-    import requests
-    req = requests.get(url)
-    file = open(dest_file, 'wb')
-    for chunk in req.iter_content(100000):
-        file.write(chunk)
-    file.close()
-    return True
+# Requests in flight and per second to the TSE server, shared by all UFs.
+# Failed requests (connection errors, 429 and 5xx) are retried by http_client with exponential backoff
+HOST_CONCURRENCY = 32
+HOST_RATE = 100
+http_client.configure('resultados.tse.jus.br', concurrency=HOST_CONCURRENCY, rate=HOST_RATE)
+
+# Manifest of the download (sqlite, in folder_path): every section of the config files and every file listed by the
+# aux json of the sections, with its status ('pending' or 'done'), updated as each file completes.
+# The published hash of the aux json names the folder of the files of the section, it isn't a digest of each file, so the
+# size and sha256 of each file are computed while it downloads and kept here for verify()
+MANIFEST_FILE = 'manifest.sqlite'
+MANIFEST_TABLES = '''
+CREATE TABLE IF NOT EXISTS tb_uf (cd_uf TEXT PRIMARY KEY, nr_secoes INTEGER);
+CREATE TABLE IF NOT EXISTS tb_secao (cd_uf TEXT, cd_municipio TEXT, nm_municipio TEXT, cd_zona TEXT, cd_secao TEXT, cd_secao2 TEXT,
+                                     status TEXT DEFAULT 'pending', PRIMARY KEY (cd_uf, cd_municipio, cd_zona, cd_secao));
+CREATE TABLE IF NOT EXISTS tb_arquivo (cd_uf TEXT, cd_municipio TEXT, cd_zona TEXT, cd_secao TEXT, nm_arquivo TEXT, cd_hash TEXT, nr_bytes INTEGER,
+                                       cd_sha256 TEXT, status TEXT DEFAULT 'pending', PRIMARY KEY (cd_uf, cd_municipio, cd_zona, cd_secao, nm_arquivo));
+CREATE INDEX IF NOT EXISTS ix_secao_status ON tb_secao (status);
+'''
+
+def open_manifest(folder_path):
+    os.makedirs(folder_path, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(folder_path, MANIFEST_FILE))
+    # WAL: a commit per file is cheap and a crash never leaves the manifest half written
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(MANIFEST_TABLES)
+    # Manifests created before the digests were kept
+    if 'cd_sha256' not in [c[1] for c in conn.execute('PRAGMA table_info(tb_arquivo)')]:
+        conn.execute('ALTER TABLE tb_arquivo ADD COLUMN cd_sha256 TEXT')
+    return conn
+
+def get_config(cd_uf):
+    url = URL_BASE + f'config/{cd_uf}/{cd_uf}-p000407-cs.json'
+    r = http_client.get(url)
+    r.raise_for_status()
+    return json.loads(r.content)
+
+def iter_sections(cd_uf, config):
+    for municipio in config['abr'][0]['mu']:
+        for zonas in municipio['zon']:
+            for sec in zonas['sec']:
+                yield cd_uf, municipio['cd'], municipio['nm'], zonas['cd'], sec['ns'], sec['nsp']
+
+def build_index(conn, ufs = UFS):
+    # Sections of every UF into the manifest, one transaction per UF. UFs already indexed are skipped, so a rerun is instant
+    indexed = {uf for uf, in conn.execute('SELECT cd_uf FROM tb_uf')}
+    for cd_uf in ufs:
+        if cd_uf in indexed:
+            continue
+        with conn:
+            cursor = conn.executemany('INSERT OR IGNORE INTO tb_secao (cd_uf, cd_municipio, nm_municipio, cd_zona, cd_secao, cd_secao2) VALUES (?, ?, ?, ?, ?, ?)',
+                                      iter_sections(cd_uf, get_config(cd_uf)))
+            conn.execute('INSERT INTO tb_uf VALUES (?, ?)', (cd_uf, cursor.rowcount))
+        print('UF: {} -> {} sections'.format(cd_uf, cursor.rowcount))
+
+def export_summary(conn, dest_file):
+    # Status of the sections as a spreadsheet, as the old resumo.xlsx
+    import pandas as pd
+    pd.read_sql('SELECT * FROM tb_secao', conn).to_excel(dest_file, index=False)
+
+# Downloading base from URL into storage (tse_storage.FolderStorage or PackStorage), using http_client
+# Size (checked against Content-Length) and sha256 are computed on the way, so the file is never read again to verify it
+def download_file(url : str, storage, key, nm_file):
+    req = http_client.get(url, stream=True)
+    req.raise_for_status()
+    size = 0
+    sha256 = hashlib.sha256()
+
+    def chunks():
+        nonlocal size
+        for chunk in req.iter_content(100000):
+            sha256.update(chunk)
+            size += len(chunk)
+            yield chunk
+        # Raised inside the storage, so a truncated file is never stored
+        expected = req.headers.get('Content-Length')
+        if expected is not None and 'Content-Encoding' not in req.headers and int(expected) != size:
+            raise IOError('{} truncated, {} of {} bytes'.format(url, size, expected))
+
+    storage.put(key, nm_file, chunks())
+    return size, sha256.hexdigest()
+
+def check_file(storage, file, full):
+    # Size and sha256 of the stored copy of a manifest row, None when it is missing.
+    # Without full, a file already done is only checked by its size, the others are hashed to be adopted
+    cd_uf, cd_municipio, cd_zona, cd_secao, nm_arquivo, nr_bytes, cd_sha256, status = file
+    if full or status != 'done' or cd_sha256 is None:
+        return storage.hash(file[:4], nm_arquivo)
+    size = storage.size(file[:4], nm_arquivo)
+    return None if size is None else (size, cd_sha256)
+
+def verify(conn, storage, workers = 8, full = False, batch_size = 10000):
+    # Check the local copy of every file of the manifest against the size recorded when it was downloaded, and with
+    # full = True also the sha256 (every file is read again, hashed in a thread pool as hashlib releases the GIL).
+    # Missing or corrupt files go back to pending, with their sections.
+    # A pending file already in storage (only complete files get there, but the run stopped before the manifest was updated)
+    # is adopted as done. Rows are read and checked batch_size at a time
+    files = conn.execute('SELECT cd_uf, cd_municipio, cd_zona, cd_secao, nm_arquivo, nr_bytes, cd_sha256, status FROM tb_arquivo')
+    done, pending = [], []
+    checked = 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = files.fetchmany(batch_size)
+            if not batch:
+                break
+            for file, local in zip(batch, executor.map(lambda f: check_file(storage, f, full), batch)):
+                cd_uf, cd_municipio, cd_zona, cd_secao, nm_arquivo, nr_bytes, cd_sha256, status = file
+                key = (cd_uf, cd_municipio, cd_zona, cd_secao, nm_arquivo)
+                if local is None:
+                    if status == 'done':
+                        pending.append(key)
+                elif status != 'done' or cd_sha256 is None:
+                    done.append((*local, *key))
+                elif local != (nr_bytes, cd_sha256):
+                    pending.append(key)
+            checked += len(batch)
+
+    with conn:
+        conn.executemany("UPDATE tb_arquivo SET status = 'done', nr_bytes = ?, cd_sha256 = ? WHERE cd_uf = ? AND cd_municipio = ? AND cd_zona = ? AND cd_secao = ? AND nm_arquivo = ?", done)
+        conn.executemany("UPDATE tb_arquivo SET status = 'pending' WHERE cd_uf = ? AND cd_municipio = ? AND cd_zona = ? AND cd_secao = ? AND nm_arquivo = ?", pending)
+        # Sections follow their files
+        conn.execute('''UPDATE tb_secao SET status = CASE WHEN EXISTS (SELECT 1 FROM tb_arquivo a WHERE a.cd_uf = tb_secao.cd_uf AND a.cd_municipio = tb_secao.cd_municipio
+                                                                      AND a.cd_zona = tb_secao.cd_zona AND a.cd_secao = tb_secao.cd_secao AND a.status != 'done')
+                                                        THEN 'pending' ELSE 'done' END
+                        WHERE EXISTS (SELECT 1 FROM tb_arquivo a WHERE a.cd_uf = tb_secao.cd_uf AND a.cd_municipio = tb_secao.cd_municipio
+                                                                   AND a.cd_zona = tb_secao.cd_zona AND a.cd_secao = tb_secao.cd_secao)''')
+    print('{} files verified in {:.1f}s: {} adopted, {} missing or corrupt'.format(checked, time.time() - start, len(done), len(pending)))
+    return pending
 
 def get_info_files(cd_uf, cd_municipio, cd_zona, cd_secao):
-    url = f'https://resultados.tse.jus.br/oficial/ele2022/arquivo-urna/407/dados/{cd_uf}/{cd_municipio}/{cd_zona}/{cd_secao}/p000407-{cd_uf}-m{cd_municipio}-z{cd_zona}-s{cd_secao}-aux.json'
-    r = requests.get(url = url, headers= header)
-    r = eval(r.content)
-    return r
+    url = URL_BASE + f'dados/{cd_uf}/{cd_municipio}/{cd_zona}/{cd_secao}/p000407-{cd_uf}-m{cd_municipio}-z{cd_zona}-s{cd_secao}-aux.json'
+    r = http_client.get(url)
+    r.raise_for_status()
+    return json.loads(r.content)
 
-def get_log_files(cd_uf,cd_municipio, cd_zona, cd_secao, folder_path):
+def get_log_files(cd_uf,cd_municipio, cd_zona, cd_secao, storage):
     hash_file = get_info_files(cd_uf=cd_uf,cd_municipio= cd_municipio, cd_zona= cd_zona, cd_secao= cd_secao)
     for hashe in hash_file['hashes']:
         cd_hash = hashe['hash']
         for nm_file in hashe['nmarq']:
-            url = f'https://resultados.tse.jus.br/oficial/ele2022/arquivo-urna/407/dados/{cd_uf}/{cd_municipio}/{cd_zona}/{cd_secao}/{cd_hash}/{nm_file}'
-            download_file(url, folder_path + f'{cd_uf}/{nm_file}')
+            url = URL_BASE + f'dados/{cd_uf}/{cd_municipio}/{cd_zona}/{cd_secao}/{cd_hash}/{nm_file}'
+            download_file(url, storage, (cd_uf, cd_municipio, cd_zona, cd_secao), nm_file)
     return True
 
-# Create Structure
-folder_path = 'C:/tse_analise/'
-ufs = ['ac', 'al', 'ap', 'am', 'ba', 'ce', 'df', 'es', 'zz', 'go', 'ma', 'mt', 'ms', 'mg', 'pr', 'pb', 'pa', 'pe', 'pi', 'rj', 'rn', 'rs', 'ro', 'rr', 'sc', 'se', 'sp', 'to']
-# Create folder
-for folder in ufs:
-    os.mkdir(folder_path + folder)
-
-# Get All Zones and Section
-df = pd.DataFrame()
-for cd_uf in ufs:
-    url = f'https://resultados.tse.jus.br/oficial/ele2022/arquivo-urna/407/config/{cd_uf}/{cd_uf}-p000407-cs.json'
-    r = requests.get(url = url, headers= header)
-    r = eval(r.content)
-
-    for municipio in r['abr'][0]['mu']:
-        print('UF: {} -> {}'.format(cd_uf, municipio['nm']))
-        for zonas in municipio['zon']:
-            for sec in zonas['sec']:
-                df = pd.concat([df, pd.DataFrame([{'cd_uf' : cd_uf,'cd_municipio' : municipio['cd'], 'nm_municipio' : municipio['nm'], 'cd_zona' : zonas['cd'],'cd_secao' : sec['ns'], 'cd_secao2': sec['nsp']}])], ignore_index=True)
-
-df['download'] = True
-# Salva arquivo de Resumo
-df.to_excel(folder_path + 'resumo.xlsx', index=False)
-
-# caso queira iniciar o download de um arquivo já gravado
-# df = pd.read_excel(folder_path + 'resumo.xlsx', dtype=str)
-
-# download all log files
-for idx, row in df.iterrows():
-    # if row['cd_uf'] != 'pe':
-    #     continue
-    if row['download']:
-        try:
-            if get_log_files(row['cd_uf'],row['cd_municipio'], row['cd_zona'], row['cd_secao'], folder_path):
-                df.loc[idx, 'download'] = False
-        except:
-            sleep(60*3)
-            if get_log_files(row['cd_uf'],row['cd_municipio'], row['cd_zona'], row['cd_secao'], folder_path):
-                df.loc[idx, 'download'] = False
-
-df.to_excel(folder_path + 'resumo.xlsx', index=False)
\ No newline at end of file
+class Progress:
+    # Sections, files and bytes downloaded by the crawler, printed every interval seconds
+    def __init__(self, sections, interval = 10):
+        self.sections = sections
+        self.interval = interval
+        self.sections_done = 0
+        self.sections_failed = 0
+        self.files = 0
+        self.bytes = 0
+        self.start = time.time()
+
+    def report(self, last_bytes, seconds):
+        elapsed = time.time() - self.start
+        rate = (self.bytes - last_bytes) / max(seconds, 1e-9)
+        print('{}/{} sections ({} failed), {} files, {:.1f} MB, {:.2f} MB/s, {:.1f} sections/s'.format(
+            self.sections_done, self.sections, self.sections_failed, self.files, self.bytes / 1024 / 1024,
+            rate / 1024 / 1024, self.sections_done / max(elapsed, 1e-9)))
+
+    async def run(self):
+        last_bytes = self.bytes
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report(last_bytes, self.interval)
+            last_bytes = self.bytes
+
+async def download_manifest_file(conn, key, url, nm_file, storage, progress):
+    size, sha256 = await asyncio.to_thread(download_file, url, storage, key, nm_file)
+    # Manifest is only touched from the event loop thread, one transaction per file
+    with conn:
+        conn.execute("UPDATE tb_arquivo SET status = 'done', nr_bytes = ?, cd_sha256 = ? WHERE cd_uf = ? AND cd_municipio = ? AND cd_zona = ? AND cd_secao = ? AND nm_arquivo = ?",
+                     (size, sha256, *key, nm_file))
+    progress.files += 1
+    progress.bytes += size
+
+async def crawl_section(conn, key, storage, progress):
+    # The aux json of the section, then all the files it lists (and not done yet) at the same time
+    cd_uf, cd_municipio, cd_zona, cd_secao = key
+    info = await asyncio.to_thread(get_info_files, *key)
+    files = [(hashe['hash'], nm_file) for hashe in info['hashes'] for nm_file in hashe['nmarq']]
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO tb_arquivo (cd_uf, cd_municipio, cd_zona, cd_secao, nm_arquivo, cd_hash) VALUES (?, ?, ?, ?, ?, ?)',
+                         [(*key, nm_file, cd_hash) for cd_hash, nm_file in files])
+    done = {nm for nm, in conn.execute("SELECT nm_arquivo FROM tb_arquivo WHERE cd_uf = ? AND cd_municipio = ? AND cd_zona = ? AND cd_secao = ? AND status = 'done'", key)}
+
+    downloads = []
+    for cd_hash, nm_file in files:
+        if nm_file in done:
+            continue
+        url = URL_BASE + f'dados/{cd_uf}/{cd_municipio}/{cd_zona}/{cd_secao}/{cd_hash}/{nm_file}'
+        downloads.append(download_manifest_file(conn, key, url, nm_file, storage, progress))
+    await asyncio.gather(*downloads)
+    with conn:
+        conn.execute("UPDATE tb_secao SET status = 'done' WHERE cd_uf = ? AND cd_municipio = ? AND cd_zona = ? AND cd_secao = ?", key)
+
+async def crawl_uf(conn, keys, storage, uf_concurrency, progress):
+    # uf_concurrency workers take the sections of the UF from a queue, so a big UF (sp, mg) doesn't hold all the connections
+    queue = asyncio.Queue()
+    for key in keys:
+        queue.put_nowait(key)
+
+    async def worker():
+        while not queue.empty():
+            key = queue.get_nowait()
+            try:
+                await crawl_section(conn, key, storage, progress)
+                progress.sections_done += 1
+            except Exception as e:
+                # The section stays pending for the next run
+                progress.sections_failed += 1
+                print('Error downloading section {} {} {} {}: {}'.format(*key, e))
+
+    await asyncio.gather(*[worker() for _ in range(uf_concurrency)])
+
+async def crawl(conn, storage, ufs = UFS, uf_concurrency = 4, interval = 10):
+    # Download the pending sections of the manifest, all UFs at the same time with at most uf_concurrency sections
+    # in flight per UF. Requests run in threads of http_client, bounded by HOST_CONCURRENCY / HOST_RATE.
+    keys = {uf: [] for uf in ufs}
+    for key in conn.execute("SELECT cd_uf, cd_municipio, cd_zona, cd_secao FROM tb_secao WHERE status != 'done'"):
+        if key[0] in keys:
+            keys[key[0]].append(key)
+    progress = Progress(sum(len(k) for k in keys.values()), interval)
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=HOST_CONCURRENCY))
+    reporter = asyncio.create_task(progress.run())
+    try:
+        await asyncio.gather(*[crawl_uf(conn, k, storage, uf_concurrency, progress) for k in keys.values()])
+    finally:
+        reporter.cancel()
+    progress.report(0, time.time() - progress.start)
+    return progress
+
+
+if __name__ == '__main__':
+    # Create Structure
+    folder_path = 'C:/tse_analise/'
+    ufs = UFS
+    # One file per artifact in folder_path/<uf>/, or per UF pack shards with an index (millions of files in a few hundred tars)
+    storage = FolderStorage(folder_path)
+    # from tse_storage import PackStorage
+    # storage = PackStorage(folder_path + 'packs')
+
+    # Get All Zones and Section, a rerun resumes from the manifest (only UFs not indexed yet are fetched)
+    conn = open_manifest(folder_path)
+    build_index(conn, ufs)
+    # After an outage only the missing or truncated files are downloaded again (full=True also hashes every file, to find corrupt ones)
+    verify(conn, storage)
+
+    # download all log files, a section that fails stays pending for the next run
+    asyncio.run(crawl(conn, storage, ufs))
+
+    # Salva arquivo de Resumo
+    # export_summary(conn, folder_path + 'resumo.xlsx')
+    conn.close()
@@ -1,22 +1,160 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
+import http_client
+
+# Workbooks are kept in CACHE_FOLDER ({dtCut}-3-tabelas.xlsx plus the ETag / Last-Modified of the server in a .json)
+# and checked again with a conditional GET when the copy is older than CACHE_TTL seconds
+CACHE_FOLDER = 'caged_cache'
+CACHE_TTL = 6 * 60 * 60
+
+# Cell ranges of the tables used by the get_* methods, all streamed in a single open of the workbook (openpyxl read only).
+# Same rows of the old read_excel + iloc + dropna: blank rows don't count, skip is the header row plus the rows dropped by iloc,
+# first_col is the first column kept (1 = A) and rows with an empty cell are dropped. Each column is (name, converter, dtype)
+def to_int(value):
+    return int(value)
+
+def to_float(value):
+    # '-' and other placeholders become NaN
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def to_text(value):
+    return str(value)
+
+def to_municipio(value):
+    # 'SP-Sao Paulo' -> 'Sao Paulo'
+    return str(value)[3:]
+
+def to_value(value):
+    return value
+
+TABLES = {'uf_base': {'sheet': 'Tabela 3', 'skip': 7, 'first_col': 2,
+                      'columns': [('UF', to_text, object), ('CodigoMunicipio', to_int, 'int64'), ('Municipio', to_municipio, object),
+                                  ('Admissoes', to_int, 'int64'), ('Demissoes', to_int, 'int64'), ('Saldo', to_int, 'int64'),
+                                  ('Variacao', to_float, 'float64')]},
+          'average_wages': {'sheet': 'Tabela 9', 'skip': 5, 'first_col': 2,
+                            'columns': [('Mes', to_value, object), ('SalarioMedioAdmissao', to_float, 'float64'),
+                                        ('SalarioMedioDesligamento', to_float, 'float64')]},
+          'cnae_section': {'sheet': 'Tabela 1', 'skip': 7, 'first_col': 2,
+                           'columns': [('Secao', to_text, object), ('Admissoes', to_int, 'int64'), ('Desligamentos', to_int, 'int64'),
+                                       ('Saldo', to_int, 'int64'), ('Variacao', to_float, 'float64')]}}
+
+# Panels of the backfill, one parquet per month in PANEL_FOLDER/<panel>/YYYY-MM.parquet: method that builds the month
+PANEL_FOLDER = 'caged_panel'
+PANELS = {'uf_base': 'get_uf_base', 'cnae_section': 'get_cnae_section'}
+
+# dtCut -> (modification time of the cached workbook, {table: DataFrame})
+sheets_cache = {}
+# One lock per dtCut, different months are fetched at the same time
+cache_locks = {}
+cache_lock = threading.Lock()
+
+def default_dtcut():
+    dtCut = pd.Timestamp.now() -  pd.DateOffset(months=1)
+    return dtCut.strftime('%b%Y').capitalize()
+
+def fetch_workbook(dtCut, cache_folder = CACHE_FOLDER, ttl = CACHE_TTL):
+    # Path of the cached workbook of dtCut, downloaded only when missing or changed on the server
+    URL = f'http://pdet.mte.gov.br/images/Novo_CAGED/{dtCut}/3-tabelas.xlsx'
+    path = os.path.join(cache_folder, f'{dtCut}-3-tabelas.xlsx')
+    meta_file = path + '.json'
+    if os.path.exists(path) and os.path.exists(meta_file) and time.time() - os.path.getmtime(meta_file) < ttl:
+        return path
+
+    headers = {}
+    if os.path.exists(path) and os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    r = http_client.get(URL, headers=headers)
+    if r.status_code != 304:
+        r.raise_for_status()
+        os.makedirs(cache_folder, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(r.content)
+        os.replace(path + '.tmp', path)
+    # Written also on 304, its modification time is the last check
+    with open(meta_file, 'w') as f:
+        json.dump({'url': URL, 'etag': r.headers.get('ETag', headers.get('If-None-Match')),
+                   'last_modified': r.headers.get('Last-Modified', headers.get('If-Modified-Since'))}, f)
+    return path
+
+def read_tables(path, tables = TABLES):
+    # Stream the cell ranges of the tables and build typed columns directly, returns {table: DataFrame}
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        result = {}
+        for name, table in tables.items():
+            ws = wb[table['sheet']]
+            # Dimensions saved by some writers are wrong, the sheet is read to its real end
+            ws.reset_dimensions()
+            first_col = table['first_col']
+            converters = [c[1] for c in table['columns']]
+            data = [[] for _ in converters]
+            skip = table['skip']
+            for row in ws.iter_rows(min_col=1, max_col=first_col + len(converters) - 1, values_only=True):
+                if all(v is None for v in row):
+                    continue
+                if skip > 0:
+                    skip -= 1
+                    continue
+                values = row[first_col - 1:]
+                if any(v is None for v in values):
+                    continue
+                for column, convert, value in zip(data, converters, values):
+                    column.append(convert(value))
+            result[name] = pd.DataFrame({c[0]: pd.Series(d, dtype=c[2]) for c, d in zip(table['columns'], data)})
+    finally:
+        wb.close()
+    return result
+
+def read_sheets(dtCut):
+    # All the TABLES of the workbook of dtCut, parsed once per version of the cached file
+    with cache_lock:
+        lock = cache_locks.setdefault(dtCut, threading.Lock())
+    with lock:
+        path = fetch_workbook(dtCut)
+        mtime = os.path.getmtime(path)
+        if dtCut not in sheets_cache or sheets_cache[dtCut][0] != mtime:
+            sheets_cache[dtCut] = (mtime, read_tables(path))
+        return sheets_cache[dtCut][1]
+
+def month_range(start, end):
+    # dtCut of every month from start to end ('Jan2020', 'Jul2022'...)
+    months = pd.period_range(pd.to_datetime(start, format='%b%Y'), pd.to_datetime(end, format='%b%Y'), freq='M')
+    return [m.strftime('%b%Y').capitalize() for m in months]
+
+def panel_path(folder, panel, dtCut):
+    return os.path.join(folder, panel, pd.to_datetime(dtCut, format='%b%Y').strftime('%Y-%m') + '.parquet')
+
+def backfill_month(dtCut):
+    # Runs in a worker process: download and parse the workbook of one month, one frame per panel with its Competencia
+    # (columns are already typed by read_tables)
+    frames = {}
+    for panel, method in PANELS.items():
+        df = getattr(CAGED, method)(dtCut)
+        df.insert(0, 'Competencia', pd.to_datetime(dtCut, format='%b%Y'))
+        frames[panel] = df
+    return frames
 
 class CAGED:
     def get_uf_base(dtCut = None):
         if dtCut is None:
-            dtCut = pd.Timestamp.now() -  pd.DateOffset(months=1)
-            dtCut = dtCut.strftime('%b%Y').capitalize()
-
-        URL = f'http://pdet.mte.gov.br/images/Novo_CAGED/{dtCut}/3-tabelas.xlsx'
-        df = pd.read_excel(URL, sheet_name = 'Tabela 3')
-        df = df.iloc[6:, 1:8]
-        df.columns = ['UF', 'CodigoMunicipio' ,'Municipio', 'Admissoes', 'Demissoes', 'Saldo', 'Variacao']
-        df.dropna(inplace=True)
-
-        df.Admissoes = pd.to_numeric(df.Admissoes)
-        df.Demissoes = pd.to_numeric(df.Demissoes)
-        df.Saldo = pd.to_numeric(df.Saldo)
+            dtCut = default_dtcut()
 
-        df.Municipio = df.Municipio.apply(lambda x: x[3:])
+        # Typed columns, Municipio without the UF prefix
+        df = read_sheets(dtCut)['uf_base'].copy()
         df.sort_values("Saldo", inplace = True, ascending = False)
         df.reset_index(inplace = True, drop = True)
         df['RankNacional'] = range(1,df.shape[0]+1)
@@ -27,35 +165,59 @@ class CAGED:
 
     def get_average_wages(dtCut = None):
         if dtCut is None:
-            dtCut = pd.Timestamp.now() -  pd.DateOffset(months=1)
-            dtCut = dtCut.strftime('%b%Y').capitalize()
-
-        URL = f'http://pdet.mte.gov.br/images/Novo_CAGED/{dtCut}/3-tabelas.xlsx'
-        df = pd.read_excel(URL, sheet_name = 'Tabela 9')
-        df = df.iloc[4:, 1:]
-        df.columns = ['Mes', 'SalarioMedioAdmissao', 'SalarioMedioDesligamento']
-        df.dropna(inplace=True)
-        df.reset_index(inplace=True, drop=True)
-        return df
+            dtCut = default_dtcut()
+
+        return read_sheets(dtCut)['average_wages'].copy()
 
     def get_cnae_section(dtCut = None):
         if dtCut is None:
-            dtCut = pd.Timestamp.now() -  pd.DateOffset(months=1)
-            dtCut = dtCut.strftime('%b%Y').capitalize()
+            dtCut = default_dtcut()
 
-        URL = f'http://pdet.mte.gov.br/images/Novo_CAGED/{dtCut}/3-tabelas.xlsx'
-        df = pd.read_excel(URL, sheet_name = 'Tabela 1')
-        df = df.iloc[6:, 1:6]
-        df.columns = ['Secao', 'Admissoes', 'Desligamentos', 'Saldo', 'Variacao']
-        df.dropna(inplace=True)
-        df.reset_index(inplace=True, drop=True)
+        return read_sheets(dtCut)['cnae_section'].copy()
 
-        return df
+    def backfill(start, end, workers = 4, folder = PANEL_FOLDER):
+        # Add the months from start to end missing in the panels, workers months downloaded and parsed at the same time.
+        # A month is only written when all its panels are built, each file written apart and renamed, so a stopped run is resumed by the next one
+        missing = [m for m in month_range(start, end) if not all(os.path.exists(panel_path(folder, p, m)) for p in PANELS)]
+        if not missing:
+            return []
+
+        done = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(backfill_month, dtCut): dtCut for dtCut in missing}
+            for future in as_completed(futures):
+                dtCut = futures[future]
+                try:
+                    frames = future.result()
+                except Exception as e:
+                    # Months not published yet, or before the Novo CAGED
+                    print(f'{dtCut} not loaded: {e}')
+                    continue
+                for panel, df in frames.items():
+                    path = panel_path(folder, panel, dtCut)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    # Files starting with '_' are ignored when the panel is read
+                    tmp = os.path.join(os.path.dirname(path), '_' + os.path.basename(path))
+                    df.to_parquet(tmp, index=False)
+                    os.replace(tmp, path)
+                done.append(dtCut)
+                print(f'{dtCut} loaded')
+        return done
+
+    def read_panel(panel = 'uf_base', folder = PANEL_FOLDER):
+        # Whole history of a panel ('uf_base' by month and municipality, 'cnae_section' by month and section)
+        df = pd.read_parquet(os.path.join(folder, panel))
+        return df.sort_values('Competencia').reset_index(drop=True)
 
 if __name__ == '__main__':
     # Type Month and Year if you want, for automatic not fill dtCut
     dtCut = 'Jul2022'
 
+    # The workbook is downloaded and parsed once for the three tables
     dfUF = CAGED.get_uf_base(dtCut)
     dfSection = CAGED.get_cnae_section(dtCut)
-    dfSalary = CAGED.get_average_wages(dtCut)
\ No newline at end of file
+    dfSalary = CAGED.get_average_wages(dtCut)
+
+    # History since the Novo CAGED, only the months not in the panel yet are downloaded
+    # CAGED.backfill('Jan2020', dtCut)
+    # dfPanel = CAGED.read_panel('uf_base')
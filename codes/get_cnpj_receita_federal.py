@@ -5,19 +5,596 @@
 
 import io
 import os
+import json
+import re
 import time
+import queue
+import struct
 import zipfile
-import requests
-import pandas as pd
-from sqlalchemy import create_engine
-from pySmartDL import SmartDL
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+# pandas, sqlalchemy, http_client (requests) and pySmartDL are imported only where they are used, so short jobs
+# (reindexing, single table reloads) don't pay for them at startup
+
+# Set layout, in order to facilitate the reading of the base a pattern was created in the first two digits, being:
+# st = string
+# cd = code
+# dt = date
+# vl = value
+# Each column is mapped to its type in Postgres
+LAYOUT_FILES = {'EMPRESAS': {'columns':
+                    {'st_cnpj_base': 'char(8)', 'st_razao_social': 'text', 'cd_natureza_juridica': 'smallint', 'cd_qualificacao': 'smallint',
+                    'vl_capital_social': 'numeric(18,2)', 'cd_porte_empresa': 'smallint', 'st_ente_federativo': 'text'},
+                    'table_name_db': 'tb_empresa'},
+                'ESTABELECIMENTOS': {'columns':
+                    {'st_cnpj_base': 'char(8)', 'st_cnpj_ordem': 'char(4)', 'st_cnpj_dv': 'char(2)', 'cd_matriz_filial': 'smallint', 'st_nome_fantasia': 'text',
+                    'cd_situacao_cadastral': 'smallint', 'dt_situacao_cadastral': 'date', 'cd_motivo_situacao_cadastral': 'smallint', 'st_cidade_exterior': 'text',
+                    'cd_pais': 'smallint', 'dt_inicio_atividade': 'date', 'cd_cnae_principal': 'integer', 'cd_cnae_secundario': 'text', 'st_tipo_logradouro': 'text',
+                    'st_logradouro': 'text', 'st_numero': 'text', 'st_complemento': 'text', 'st_bairro': 'text', 'st_cep': 'text', 'st_uf': 'char(2)',
+                    'cd_municipio': 'smallint', 'st_ddd1': 'text', 'st_telefone1': 'text', 'st_ddd2': 'text', 'st_telefone2': 'text', 'st_ddd_fax': 'text',
+                    'st_fax': 'text', 'st_email': 'text', 'st_situacao_especial': 'text', 'dt_situacao_especial': 'date'
+                    }, 'table_name_db': 'tb_estabelecimento', 'partition_by': 'st_uf'},
+                'SIMPLES': {'columns':
+                    {'st_cnpj_base': 'char(8)', 'st_opcao_simples': 'char(1)', 'dt_opcao_simples': 'date', 'dt_exclusao_simples': 'date',
+                    'st_opcao_mei': 'char(1)', 'dt_opcao_mei': 'date', 'dt_exclusao_mei': 'date'
+                    }, 'table_name_db': 'tb_dados_simples'},
+                'SOCIOS': {'columns':
+                    {'st_cnpj_base': 'char(8)', 'cd_tipo': 'smallint', 'st_nome': 'text', 'st_cpf_cnpj': 'text', 'cd_qualificacao': 'smallint', 'dt_entrada': 'date',
+                    'cd_pais': 'smallint', 'st_representante': 'text', 'st_nome_representante': 'text', 'cd_qualificacao_representante': 'smallint',
+                    'cd_faixa_etaria': 'smallint'},
+                    'table_name_db': 'tb_socio'},
+                'PAISES': {'columns': {'cd_pais': 'smallint', 'st_pais': 'text'}, 'table_name_db': 'tb_pais'},
+                'MUNICIPIOS': {'columns': {'cd_municipio': 'smallint', 'st_municipio': 'text'}, 'table_name_db': 'tb_municipios'},
+                'QUALIFICACOES': {'columns': {'cd_qualificacao': 'smallint', 'st_qualificacao': 'text'}, 'table_name_db': 'tb_qualificacao_socio'},
+                'NATUREZAS': {'columns': {'cd_natureza_juridica': 'smallint', 'st_natureza_juridica': 'text'}, 'table_name_db': 'tb_natureza_juridica'},
+                'MOTIVOS': {'columns': {'cd_motivo_situacao_cadastral': 'smallint', 'st_motivo_situacao_cadastral': 'text'}, 'table_name_db': 'tb_motivo_situacao_cadastral'},
+                'CNAES': {'columns': {'cd_cnae': 'integer', 'st_cnae': 'text'}, 'table_name_db': 'tb_cnae'}
+                }
+
+# Partitions of the tables partitioned by st_uf (EX = abroad), anything else goes to the default partition
+UFS = ['AC', 'AL', 'AP', 'AM', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MT', 'MS', 'MG', 'PR', 'PB', 'PA', 'PE', 'PI', 'RJ', 'RN', 'RS', 'RO', 'RR', 'SC', 'SE', 'SP', 'TO', 'EX']
+INTEGER_TYPES = ['smallint', 'integer', 'bigint']
+
+# Table with the chunks already loaded, to resume interrupted loads
+CHECKPOINT_TABLE = 'tb_load_checkpoint'
+
+# Indexes created by DB_CNPJ.index_db, method being:
+# btree = composite CNPJ key, also serves lookups by st_cnpj_base alone and ranges
+# gin_trgm = name columns, serves prefix, LIKE/ILIKE and similarity searches (pg_trgm)
+# hash = columns only used in equality
+INDEX_PLAN = [{'name': 'ix_estab_cnpj', 'table': 'tb_estabelecimento', 'columns': ['st_cnpj_base', 'st_cnpj_ordem', 'st_cnpj_dv'], 'method': 'btree'},
+              {'name': 'ix_estab_nome_fantasia_trgm', 'table': 'tb_estabelecimento', 'columns': ['st_nome_fantasia'], 'method': 'gin_trgm'},
+              {'name': 'ix_estab_uf', 'table': 'tb_estabelecimento', 'columns': ['st_uf'], 'method': 'hash'},
+              {'name': 'ix_estab_municipio', 'table': 'tb_estabelecimento', 'columns': ['cd_municipio'], 'method': 'hash'},
+              {'name': 'ix_muni_cod_municipio', 'table': 'tb_municipios', 'columns': ['cd_municipio'], 'method': 'hash'},
+              {'name': 'ix_muni_municipio', 'table': 'tb_municipios', 'columns': ['st_municipio'], 'method': 'hash'},
+              {'name': 'ix_simples_cnpj_base', 'table': 'tb_dados_simples', 'columns': ['st_cnpj_base'], 'method': 'hash'},
+              {'name': 'ix_empresa_cnpj_base', 'table': 'tb_empresa', 'columns': ['st_cnpj_base'], 'method': 'hash'},
+              {'name': 'ix_empresa_razao_social_trgm', 'table': 'tb_empresa', 'columns': ['st_razao_social'], 'method': 'gin_trgm'},
+              {'name': 'ix_socio_cnpj_base', 'table': 'tb_socio', 'columns': ['st_cnpj_base'], 'method': 'hash'}
+              ]
+
+class LoadMetrics:
+    # Timings, rows and bytes of each stage of the load (download, decompress, parse, format, copy...), plus retries and sleeps
+    # log_file: each event is also appended to it as a JSON line
+    def __init__(self, log_file = None):
+        self.log_file = log_file
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, file, seconds = 0.0, rows = 0, bytes = 0, **fields):
+        with self.lock:
+            total = self.totals.setdefault(stage, {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+            total['count'] += 1
+            total['seconds'] += seconds
+            total['rows'] += rows
+            total['bytes'] += bytes
+            if self.log_file is not None:
+                event = {'time': time.time(), 'pid': os.getpid(), 'stage': stage, 'file': file, 'seconds': seconds, 'rows': rows, 'bytes': bytes}
+                event.update(fields)
+                with open(self.log_file, 'a') as f:
+                    f.write(json.dumps(event) + '\n')
+
+    def merge(self, totals):
+        # Add the totals of another LoadMetrics (e.g. from a worker process)
+        with self.lock:
+            for stage, other in totals.items():
+                total = self.totals.setdefault(stage, {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+                for key in total:
+                    total[key] += other[key]
+
+    def write_prometheus(self, path):
+        # Prometheus textfile (node_exporter textfile collector), replaced atomically
+        lines = []
+        for name, key, description in [('cnpj_load_stage_events_total', 'count', 'Events recorded in each stage of the CNPJ load'),
+                                       ('cnpj_load_stage_seconds_total', 'seconds', 'Seconds spent in each stage of the CNPJ load'),
+                                       ('cnpj_load_stage_rows_total', 'rows', 'Rows processed in each stage of the CNPJ load'),
+                                       ('cnpj_load_stage_bytes_total', 'bytes', 'Bytes processed in each stage of the CNPJ load')]:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} counter')
+            for stage, total in sorted(self.totals.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {total[key]}')
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+class MeteredReader(io.RawIOBase):
+    # Raw stream that counts the time and bytes spent reading (decompressing) the zip member
+    def __init__(self, raw):
+        self.raw = raw
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        start = time.time()
+        data = self.raw.read(len(b))
+        self.seconds += time.time() - start
+        b[:len(data)] = data
+        self.bytes += len(data)
+        return len(data)
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+def get_model(file):
+    # Select layout from filename (e.g. Estabelecimentos3.zip -> ESTABELECIMENTOS)
+    return ''.join(letter for letter in file.split('.')[0] if letter.isalpha()).upper()
+
+def read_zip_chunks(file, columns, chunksize = 65000, streaming = True, skiprows = 0, metrics = None):
+    # Read the csv inside the zip file in chunks of rows
+    # skiprows: rows already loaded, skipped by the csv tokenizer without being parsed into chunks
+    # streaming = True: the member is decompressed and decoded from ISO-8859-1 on the fly, so only
+    # the current chunk is kept in memory (ESTABELECIMENTOS files have several GB once unzipped)
+    # streaming = False: the whole member is unzipped into memory before reading (old behaviour)
+    import pandas as pd
+    if metrics is None:
+        metrics = LoadMetrics()
+
+    with zipfile.ZipFile(file, 'r') as zip_ref:
+        member = zip_ref.namelist()[0]
+        if streaming:
+            reader = MeteredReader(zip_ref.open(member, 'r'))
+        else:
+            start = time.time()
+            data = zip_ref.read(member)
+            metrics.record('decompress', file, time.time() - start, bytes=len(data))
+            reader = MeteredReader(io.BytesIO(data))
+        source = io.TextIOWrapper(io.BufferedReader(reader, 1024 * 1024), encoding='ISO-8859-1', newline='')
+
+        with source:
+            chunks = pd.read_csv(source, delimiter=';', header=None, chunksize=chunksize, names=list(columns),
+                                 iterator=True, dtype=str, encoding='ISO-8859-1', skiprows=skiprows)
+            while True:
+                # Time reading the chunk is split between decompression (inside the reader) and parsing
+                start, decompress_seconds, decompress_bytes = time.time(), reader.seconds, reader.bytes
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                decompress_seconds = reader.seconds - decompress_seconds
+                if streaming:
+                    metrics.record('decompress', file, decompress_seconds, bytes=reader.bytes - decompress_bytes)
+                metrics.record('parse', file, time.time() - start - decompress_seconds, rows=chunk.shape[0])
+                yield chunk
+
+def format_chunk(chunk, layout):
+    # Convert the text columns of a chunk to the types of the layout
+    import pandas as pd
+    for i, sql_type in layout['columns'].items():
+        # Format date columns
+        if sql_type == 'date':
+            chunk.loc[chunk[i] == '00000000', i] = None
+            chunk.loc[chunk[i] == '0', i] = None
+            chunk[i] = pd.to_datetime(chunk[i], format='%Y%m%d', errors='coerce').dt.strftime('%Y-%m-%d')
+        # Invalid codes become NULL instead of failing the COPY
+        elif sql_type in INTEGER_TYPES:
+            chunk[i] = pd.to_numeric(chunk[i], errors='coerce').astype('Int64')
+        # Capital uses decimal comma, kept as text so Postgres parses the exact value
+        elif sql_type.startswith('numeric'):
+            chunk[i] = chunk[i].str.replace(',', '.', regex=False).where(chunk[i].str.fullmatch(r'-?[0-9]+(,[0-9]+)?') == True)
+        else:
+            chunk[i] = chunk[i].fillna('')
+
+class IteratorReader(io.RawIOBase):
+    # File-like object reading from an iterator of bytes, feeds copy_expert without building the whole buffer
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.pending) == 0:
+            data = next(self.iterator, None)
+            if data is None:
+                return 0
+            self.pending = memoryview(data)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+# Binary COPY format of PostgreSQL
+PG_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PG_INTEGER_TYPES = {'smallint': '>i2', 'integer': '>i4', 'bigint': '>i8'}
+# Column types of the tables already used by psql_insert_copy_binary
+pg_column_types = {}
+
+def encode_numeric(value):
+    # Binary numeric (without the field length): number of base 10000 digits, weight of the first digit, sign, display scale and the digits
+    from decimal import Decimal
+    sign, digits, exponent = Decimal(value).as_tuple()
+    digits = ''.join(map(str, digits))
+    if exponent > 0:
+        digits += '0' * exponent
+        exponent = 0
+    dscale = -exponent
+    digits = digits.zfill(dscale + 1)
+    integer = digits[:len(digits) - dscale]
+    fraction = digits[len(digits) - dscale:]
+    integer = integer.zfill((len(integer) + 3) // 4 * 4)
+    fraction = fraction + '0' * (-len(fraction) % 4)
+    groups = [int(integer[i:i + 4]) for i in range(0, len(integer), 4)] + [int(fraction[i:i + 4]) for i in range(0, len(fraction), 4)]
+    weight = len(integer) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if groups == []:
+        weight = 0
+    return struct.pack(f'>hhhh{len(groups)}h', len(groups), weight, 0x4000 if sign else 0, dscale, *groups)
+
+def numeric_fields(values, pg_type):
+    # Binary numeric of text values for numeric(p,s) with p <= 18, without a Python object per value: arrow parses the exact
+    # value scaled to an int64, numpy splits it in base 10000 digits (integer part, then the fraction padded to 4 digits).
+    # Returns the lengths and the payload, or None when the type or a value doesn't fit (more decimals or digits than the type)
+    import numpy as np
+    import pyarrow as pa
+    match = re.fullmatch(r'numeric\((\d+),(\d+)\)', pg_type.replace(' ', ''))
+    if match is None:
+        return None
+    precision, scale = int(match.group(1)), int(match.group(2))
+    fraction_groups = (scale + 3) // 4
+    integer_groups = max((precision - scale + 3) // 4, 1)
+    if precision > 18 or fraction_groups * 4 > 18:
+        return None
+    try:
+        decimals = pa.array(values, type=pa.string(), from_pandas=True).cast(pa.decimal128(precision, scale))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return None
+    # Little endian 128 bit integers, the low 64 bits are the whole value with p <= 18
+    unscaled = np.frombuffer(decimals.buffers()[1], dtype='int64')[2 * decimals.offset:2 * (decimals.offset + len(decimals)):2]
+    absolute = np.abs(unscaled)
+    integer = absolute // 10 ** scale
+    fraction = absolute % 10 ** scale * 10 ** (fraction_groups * 4 - scale)
+    groups = np.stack([integer // 10000 ** k % 10000 for k in range(integer_groups - 1, -1, -1)] +
+                      [fraction // 10000 ** k % 10000 for k in range(fraction_groups - 1, -1, -1)], axis=1)
+    # Leading and trailing zero digits are dropped, weight is the position of the first digit kept (0 = units)
+    nonzero = groups != 0
+    kept = nonzero.any(axis=1)
+    first = np.argmax(nonzero, axis=1)
+    last = groups.shape[1] - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+    ndigits = np.where(kept, last - first + 1, 0)
+    weight = np.where(kept, integer_groups - 1 - first, 0)
+    position = np.arange(groups.shape[1])
+    keep = np.concatenate((np.ones((len(values), 4), dtype=bool), kept[:, None] & (position >= first[:, None]) & (position <= last[:, None])), axis=1)
+    header = np.stack([ndigits, weight, np.where(unscaled < 0, 0x4000, 0), np.full(len(values), scale)], axis=1)
+    payload = np.concatenate((header, groups), axis=1)[keep].astype('>i2').view(np.uint8)
+    return 8 + 2 * ndigits, payload
+
+# Ranges of the binary integer types, values outside them are rejected as the csv COPY and the ELT cast do
+PG_INTEGER_RANGES = {'smallint': (-2 ** 15, 2 ** 15 - 1), 'integer': (-2 ** 31, 2 ** 31 - 1), 'bigint': (-2 ** 63, 2 ** 63 - 1)}
+
+def binary_copy_fields(column, pg_type):
+    # Encode a column (pandas Series) as the binary COPY fields of its rows, without a Python object per value:
+    # returns the length of each field (-1 for NULL) and the payload of the fields not NULL, concatenated (numpy uint8)
+    # Empty strings are NULL, as in the csv COPY of psql_insert_copy
+    import numpy as np
+    import pandas as pd
+    if pg_type in PG_INTEGER_TYPES or pg_type == 'date':
+        if pg_type == 'date':
+            # Days since 2000-01-01
+            values = pd.to_datetime(column, errors='coerce')
+            mask = values.isna().to_numpy()
+            values = (values - pd.Timestamp('2000-01-01')).dt.days.fillna(0).to_numpy('int64')
+            dtype = '>i4'
+        else:
+            values = pd.to_numeric(column, errors='coerce')
+            mask = values.isna().to_numpy()
+            values = values.fillna(0).to_numpy('int64')
+            dtype = PG_INTEGER_TYPES[pg_type]
+            low, high = PG_INTEGER_RANGES[pg_type]
+            out_of_range = ~mask & ((values < low) | (values > high))
+            if out_of_range.any():
+                raise ValueError(f'{column.name}: value {values[out_of_range][0]} out of range for type {pg_type}')
+        width = np.dtype(dtype).itemsize
+        lengths = np.where(mask, -1, width).astype('int64')
+        return lengths, values[~mask].astype(dtype).view(np.uint8)
+
+    if pg_type.startswith('numeric'):
+        valid = column.notna().to_numpy() & (column != '').to_numpy()
+        lengths = np.full(len(column), -1, dtype='int64')
+        if not valid.any():
+            return lengths, np.empty(0, dtype=np.uint8)
+        fields = numeric_fields(column[valid], pg_type)
+        if fields is None:
+            # Types without precision, or values arrow can't cast exactly: one value at a time
+            fields = [encode_numeric(v) for v in column[valid]]
+            lengths[valid] = [len(f) for f in fields]
+            return lengths, np.frombuffer(b''.join(fields), dtype=np.uint8)
+        lengths[valid] = fields[0]
+        return lengths, fields[1]
+
+    # Text types: the values are joined with NUL (never valid in Postgres text) and encoded at once,
+    # the lengths in bytes come from the positions of the separators
+    # One numpy object array per column (iterating a Series is slow with the arrow backed strings of recent pandas)
+    values = pd.Series(column).astype(object).to_numpy(dtype=object, na_value='')
+    valid = values != ''
+    lengths = np.full(len(values), -1, dtype='int64')
+    if not valid.any():
+        return lengths, np.empty(0, dtype=np.uint8)
+    data = np.frombuffer('\x00'.join(map(str, values[valid])).encode('utf8'), dtype=np.uint8)
+    separators = np.flatnonzero(data == 0)
+    if len(separators) != valid.sum() - 1:
+        raise ValueError(f'{column.name}: text with NUL characters can not be copied')
+    lengths[valid] = np.diff(np.concatenate(([-1], separators, [len(data)]))) - 1
+    return lengths, data[data != 0]
+
+def binary_copy_rows(fields):
+    # Assemble the tuples of a batch (field count, then length + payload of each field) into one buffer with numpy
+    import numpy as np
+    lengths = np.stack([f[0] for f in fields], axis=1)
+    rows, ncols = lengths.shape
+    sizes = 4 + np.maximum(lengths, 0)
+    row_sizes = 2 + sizes.sum(axis=1)
+    row_starts = np.concatenate(([0], np.cumsum(row_sizes)[:-1]))
+    field_starts = row_starts[:, None] + 2 + np.concatenate((np.zeros((rows, 1), 'int64'), np.cumsum(sizes, axis=1)[:, :-1]), axis=1)
+
+    out = np.empty(int(row_sizes.sum()), dtype=np.uint8)
+    header = np.frombuffer(struct.pack('>h', ncols), dtype=np.uint8)
+    out[row_starts[:, None] + np.arange(2)] = header
+    out[field_starts[:, :, None] + np.arange(4)] = lengths.astype('>i4').view(np.uint8).reshape(rows, ncols, 4)
+    for j, (column_lengths, payload) in enumerate(fields):
+        column_lengths = np.maximum(column_lengths, 0)
+        if len(payload) == 0:
+            continue
+        # Destination of each payload byte: start of its field data plus its position inside the field
+        payload_starts = np.concatenate(([0], np.cumsum(column_lengths)[:-1]))
+        out[np.repeat(field_starts[:, j] + 4 - payload_starts, column_lengths) + np.arange(len(payload))] = payload
+    return out.tobytes()
+
+def binary_copy_data(frame, types, batch = 10000):
+    # Binary COPY stream of the columns of frame (DataFrame), encoded batch rows at a time
+    yield PG_COPY_HEADER
+    for start in range(0, frame.shape[0], batch):
+        part = frame.iloc[start:start + batch]
+        yield binary_copy_rows([binary_copy_fields(part.iloc[:, j], t) for j, t in enumerate(types)])
+    yield struct.pack('>h', -1)
+
+def copy_binary(cur, table_name, frame):
+    # Binary COPY of a DataFrame, encoded from its columns with the types of the table (integers, dates and numeric natively)
+    if table_name not in pg_column_types:
+        cur.execute("SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+                    (table_name,))
+        pg_column_types[table_name] = dict(cur.fetchall())
+    types = [pg_column_types[table_name][k] for k in frame.columns]
+    sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT binary)'.format(
+        table_name, ', '.join(['"{}"'.format(k) for k in frame.columns]))
+    cur.copy_expert(sql=sql, file=IteratorReader(binary_copy_data(frame, types)), size=1024 * 1024)
+
+def create_checkpoint_table(engine):
+    # Chunks already loaded by file, each row is committed in the same transaction as the COPY of its chunk
+    engine.execute(f"""CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (st_file text, vl_file_size bigint, cd_chunk integer, vl_rows integer,
+                                                                      st_table text, dt_loaded timestamp DEFAULT now(), PRIMARY KEY (st_file, cd_chunk))""")
+
+def get_checkpoint(engine, file):
+    # Rows and next chunk of file to load, checkpoints of another version of the file (other size) are ignored
+    rows, chunk = engine.execute(f"""SELECT COALESCE(SUM(vl_rows), 0), COALESCE(MAX(cd_chunk), -1) + 1 FROM {CHECKPOINT_TABLE}
+                                     WHERE st_file = '{file}' AND vl_file_size = {os.path.getsize(file)}""").fetchone()
+    return int(rows), int(chunk)
+
+def upload_chunk(engine, chunk, file, ordinal, layout, copy_format = 'csv'):
+    with engine.begin() as conn:
+        if copy_format == 'binary':
+            # Straight from the columns of the chunk, without the row tuples of to_sql
+            with conn.connection.cursor() as cur:
+                copy_binary(cur, layout['table_name_db'], chunk)
+        else:
+            chunk.to_sql(layout['table_name_db'], conn, if_exists="append", index=False, method= DB_CNPJ.psql_insert_copy)
+        conn.execute(f"""INSERT INTO {CHECKPOINT_TABLE} (st_file, vl_file_size, cd_chunk, vl_rows, st_table)
+                         VALUES ('{file}', {os.path.getsize(file)}, {ordinal}, {chunk.shape[0]}, '{layout['table_name_db']}')""")
+
+def upload_zip_file(engine, file, layout, streaming = True, metrics = None, copy_format = 'csv'):
+    # Load one zip file into its table, returns the number of rows loaded
+    # copy_format = 'binary': chunks are sent with binary COPY instead of csv
+    # A file interrupted in the middle is resumed after its last committed chunk
+    if metrics is None:
+        metrics = LoadMetrics()
+
+    file_start = time.time()
+    skiprows, ordinal = get_checkpoint(engine, file)
+    rows = 0
+    for chunk in read_zip_chunks(file, layout['columns'].keys(), streaming=streaming, skiprows=skiprows, metrics=metrics):
+        start = time.time()
+        format_chunk(chunk, layout)
+        metrics.record('format', file, time.time() - start, rows=chunk.shape[0])
+
+        # Using Try for connection attempts, if the connection is lost, wait 60 seconds to retry
+        # A failed chunk is rolled back with its checkpoint, so the retry doesn't duplicate rows
+        start = time.time()
+        try:
+            upload_chunk(engine, chunk, file, ordinal, layout, copy_format)
+        except Exception as e:
+            metrics.record('copy_failed', file, time.time() - start, chunk=ordinal, error=str(e))
+            time.sleep(60)
+            metrics.record('retry_sleep', file, 60, chunk=ordinal)
+            start = time.time()
+            upload_chunk(engine, chunk, file, ordinal, layout, copy_format)
+        metrics.record('copy', file, time.time() - start, rows=chunk.shape[0], chunk=ordinal)
+        rows += chunk.shape[0]
+        ordinal += 1
+
+    metrics.record('file', file, time.time() - file_start, rows=rows, bytes=os.path.getsize(file), skipped_rows=skiprows)
+    return rows
+
+def arrow_type(sql_type):
+    import pyarrow as pa
+    if sql_type == 'date':
+        return pa.date32()
+    if sql_type == 'smallint':
+        return pa.int16()
+    if sql_type == 'integer':
+        return pa.int32()
+    if sql_type == 'bigint':
+        return pa.int64()
+    if sql_type.startswith('numeric'):
+        precision, scale = sql_type[sql_type.find('(') + 1:-1].split(',')
+        return pa.decimal128(int(precision), int(scale))
+    return pa.string()
+
+def chunk_to_arrow(chunk, schema):
+    # Build an arrow table from a chunk already converted by format_chunk
+    import pandas as pd
+    import pyarrow as pa
+    from decimal import Decimal
+    arrays = []
+    for field in schema:
+        column = chunk[field.name]
+        if pa.types.is_date32(field.type):
+            arrays.append(pa.array(pd.to_datetime(column, format='%Y-%m-%d', errors='coerce'), from_pandas=True).cast(field.type))
+        elif pa.types.is_integer(field.type):
+            arrays.append(pa.array(column, from_pandas=True).cast(field.type))
+        elif pa.types.is_decimal(field.type):
+            arrays.append(pa.array([Decimal(v) if isinstance(v, str) else None for v in column], type=field.type))
+        else:
+            arrays.append(pa.array(column.where(column != ''), type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def write_zip_file_parquet(file, layout, folder, chunksize = 500000):
+    # Write one zip file as parquet under folder/<table>, partitioned by UF (folder/<table>/st_uf=SP/...) when the layout has 'partition_by'
+    # Each chunk becomes a row group, returns the number of rows written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    partition_by = layout.get('partition_by')
+    schema = pa.schema([(c, arrow_type(t)) for c, t in layout['columns'].items() if c != partition_by])
+    # Codes have few distinct values
+    dictionary = [c for c in schema.names if c.startswith('cd_')]
+    name = file.split('.')[0].lower()
+    writers = {}
+    rows = 0
+    try:
+        for chunk in read_zip_chunks(file, layout['columns'].keys(), chunksize=chunksize):
+            format_chunk(chunk, layout)
+            groups = chunk.groupby(chunk[partition_by].replace('', '__HIVE_DEFAULT_PARTITION__')) if partition_by else [(None, chunk)]
+            for value, group in groups:
+                if value not in writers:
+                    path = os.path.join(folder, layout['table_name_db'])
+                    if partition_by:
+                        path = os.path.join(path, f'{partition_by}={value}')
+                    os.makedirs(path, exist_ok=True)
+                    writers[value] = pq.ParquetWriter(os.path.join(path, f'{name}.parquet'), schema, compression='zstd', use_dictionary=dictionary)
+                writers[value].write_table(chunk_to_arrow(group, schema))
+            rows += chunk.shape[0]
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return rows
+
+def staging_select_expr(column, sql_type):
+    # SQL expression applied to a raw text column of the staging table
+    if sql_type == 'date':
+        # '00000000', '0' and malformed or impossible dates (20220230, 20221301) become NULL, as in format_chunk.
+        # to_date raises on impossible dates, so they are checked first: the branches of CASE are evaluated in order
+        year, month, day = (f'substr({column}, {i}, {n})::int' for i, n in [(1, 4), (5, 2), (7, 2)])
+        return (f"CASE WHEN {column} !~ '^[0-9]{{8}}$' OR {column} = '00000000' THEN NULL "
+                f"WHEN {year} < 1 OR {month} NOT BETWEEN 1 AND 12 THEN NULL "
+                f"WHEN {day} BETWEEN 1 AND extract(day from make_date({year}, {month}, 1) + interval '1 month - 1 day') "
+                f"THEN to_date({column}, 'YYYYMMDD') END")
+    if sql_type in INTEGER_TYPES:
+        return f"CASE WHEN TRIM({column}) ~ '^-?[0-9]+$' THEN TRIM({column})::{sql_type} END"
+    if sql_type.startswith('numeric'):
+        return f"CASE WHEN TRIM({column}) ~ '^-?[0-9]+(,[0-9]+)?$' THEN REPLACE(TRIM({column}), ',', '.')::{sql_type} END"
+    return f"NULLIF(TRIM({column}), '')"
+
+def upload_zip_file_elt(engine, file, layout, metrics = None):
+    # Load one zip file without pandas: the raw csv is copied unchanged (still ISO-8859-1, Postgres converts it)
+    # into an UNLOGGED text staging table, then a single INSERT ... SELECT formats and moves the rows to the final table
+    # The whole file is a single chunk, checkpointed in the same transaction
+    if metrics is None:
+        metrics = LoadMetrics()
+
+    if get_checkpoint(engine, file)[1] > 0:
+        return 0
+
+    file_start = time.time()
+
+    columns = list(layout['columns'].keys())
+    staging = 'stg_' + file.split('.')[0].lower()
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur, zipfile.ZipFile(file, 'r') as zip_ref:
+            cur.execute(f'DROP TABLE IF EXISTS {staging}')
+            cur.execute('CREATE UNLOGGED TABLE {} ({})'.format(staging, ', '.join(f'{c} text' for c in columns)))
+            start = time.time()
+            with MeteredReader(zip_ref.open(zip_ref.namelist()[0], 'r')) as source:
+                cur.copy_expert(f"""COPY {staging} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, DELIMITER ';', QUOTE '"', ENCODING 'LATIN1')""",
+                                source, size=1024 * 1024)
+            metrics.record('decompress', file, source.seconds, bytes=source.bytes)
+            metrics.record('staging_copy', file, time.time() - start - source.seconds, bytes=source.bytes)
+            start = time.time()
+            cur.execute('INSERT INTO {} ({}) SELECT {} FROM {}'.format(layout['table_name_db'], ', '.join(columns),
+                                                                      ', '.join(staging_select_expr(c, t) for c, t in layout['columns'].items()), staging))
+            rows = cur.rowcount
+            metrics.record('transform', file, time.time() - start, rows=rows)
+            cur.execute(f"""INSERT INTO {CHECKPOINT_TABLE} (st_file, vl_file_size, cd_chunk, vl_rows, st_table)
+                            VALUES ('{file}', {os.path.getsize(file)}, 0, {rows}, '{layout['table_name_db']}')""")
+            cur.execute(f'DROP TABLE {staging}')
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    metrics.record('file', file, time.time() - file_start, rows=rows, bytes=os.path.getsize(file))
+    return rows
+
+# Engine of each worker process of the parallel load, a single pooled connection reused for every file the worker takes
+worker_engine = None
+
+def init_upload_worker(engine_url):
+    from sqlalchemy import create_engine
+    global worker_engine
+    worker_engine = create_engine(engine_url, pool_size=1, max_overflow=0, pool_pre_ping=True)
+
+def upload_worker(file, layout, streaming, loader, log_file):
+    # Metrics of the file are returned to be added to the metrics of the parent process
+    metrics = LoadMetrics(log_file)
+    start = time.time()
+    if loader == 'elt':
+        rows = upload_zip_file_elt(worker_engine, file, layout, metrics)
+    else:
+        rows = upload_zip_file(worker_engine, file, layout, streaming, metrics, 'binary' if loader == 'binary' else 'csv')
+    return file, os.getpid(), rows, time.time() - start, metrics.totals
 
 class DB_CNPJ:
     # Function download files
-    def download_file(self, url: str, dest_file: str):
-        _ = SmartDL(url, dest_file).start()
+    def download_file(self, url: str, dest_file: str, progress_bar = True):
+        from pySmartDL import SmartDL
+        start = time.time()
+        _ = SmartDL(url, dest_file, progress_bar=progress_bar).start()
+        self.metrics.record('download', os.path.basename(dest_file), time.time() - start, bytes=os.path.getsize(dest_file))
 
-    def __init__(self, user, password, ip_postgres, schema):
+    def __init__(self, user, password, ip_postgres, schema, offline = False, listing_ttl = 24 * 60 * 60):
+        # The listing of the remote files is only fetched when needed (see df) and cached in listing_file for listing_ttl seconds
+        # offline = True: the server is never reached, only the zips in the working folder are used
         # Set Variables
         self.url_base = 'http://200.152.38.155/CNPJ/'
         self.user = user
@@ -27,11 +604,45 @@ class DB_CNPJ:
         self.files = []
         self.uploaded = []
         self.engine = None
-        HTML = requests.get(self.url_base)
+        self.layout_files = LAYOUT_FILES
+        self.manifest_file = 'manifest.json'
+        self.listing_file = 'listing.json'
+        self.listing_ttl = listing_ttl
+        self.offline = offline
+        self._df = None
+        # Metrics of the load, set metrics = LoadMetrics('load.jsonl') for JSON logs and prometheus_file for a Prometheus textfile
+        self.metrics = LoadMetrics()
+        self.prometheus_file = None
+
+    def get_listing(self):
+        import pandas as pd
+        if self.offline:
+            names = sorted(f for f in os.listdir() if f.lower().endswith('.zip') and get_model(f) in self.layout_files)
+            return pd.DataFrame({'Name': names})
+
+        if os.path.exists(self.listing_file) and time.time() - os.path.getmtime(self.listing_file) < self.listing_ttl:
+            with open(self.listing_file, 'r') as f:
+                return pd.DataFrame(json.load(f))
+
+        import http_client
+        HTML = http_client.get(self.url_base)
         df = pd.read_html(HTML.content.decode('utf8'))[0]
         df = df.drop(columns=['Unnamed: 0', 'Description'])
         df = df[df['Name'].str.find('.zip') > 0]
-        self.df = df
+        with open(self.listing_file, 'w') as f:
+            json.dump(df.astype(str).to_dict('records'), f, indent=2)
+        return df
+
+    @property
+    def df(self):
+        # Files available to download and load
+        if self._df is None:
+            self._df = self.get_listing()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
 
     def download_files(self, files = []):
         # Create an array with filenames and start download
@@ -44,7 +655,7 @@ class DB_CNPJ:
 
         for _ , row in self.df.iterrows():
             if row.Name in files:
-                self.download_file(self.url_base + row.Name, os.getcwd() + '\\' + row.Name)
+                self.download_file(self.url_base + row.Name, os.path.join(os.getcwd(), row.Name))
 
     def psql_insert_copy(table, conn, keys, data_iter):
         import csv
@@ -77,112 +688,309 @@ class DB_CNPJ:
                 table_name, columns)
             cur.copy_expert(sql=sql, file=s_buf)
 
-    def upload_to_postgresql(self, first_upload_truncate = False):
-        # Set layout, in order to facilitate the reading of the base a pattern was created in the first two digits, being:
-        # st = string
-        # cd = code
-        # dt = date
+    def psql_insert_copy_binary(table, conn, keys, data_iter):
+        """
+        Execute SQL statement inserting data with COPY in binary format, columns are encoded
+        with the types of the table (integers, dates and numeric natively) and streamed to the cursor
+
+        Parameters
+        ----------
+        table : pandas.io.sql.SQLTable
+        conn : sqlalchemy.engine.Engine or sqlalchemy.engine.Connection
+        keys : list of str
+            Column names
+        data_iter : Iterable that iterates the values to be inserted
+        """
+        # to_sql only gives row tuples, the loader (upload_chunk) calls copy_binary with the chunk instead
+        import pandas as pd
+        # gets a DBAPI connection that can provide a cursor
+        dbapi_conn = conn.connection
+        with dbapi_conn.cursor() as cur:
+            if table.schema:
+                table_name = '{}.{}'.format(table.schema, table.name)
+            else:
+                table_name = table.name
+            copy_binary(cur, table_name, pd.DataFrame.from_records(list(data_iter), columns=keys))
+
+    def get_remote_info(self, file):
+        # Size, Last-Modified and ETag of a remote file, used to find the files changed since the last refresh
+        import http_client
+        r = http_client.head(self.url_base + file)
+        return {'size': r.headers.get('Content-Length'), 'last_modified': r.headers.get('Last-Modified'), 'etag': r.headers.get('ETag')}
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return {}
+        with open(self.manifest_file, 'r') as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        with open(self.manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
 
+    def refresh(self, workers = 1, loader = 'elt', partitioned = False):
+        # Incremental refresh, only tables with files changed since the last refresh (see manifest_file) are reloaded.
+        # They are loaded and indexed in a shadow schema and moved to the live schema in a single transaction,
+        # so readers never see empty or half loaded tables
+        manifest = self.load_manifest()
+        remote = {file: self.get_remote_info(file) for file in self.df.Name.values}
+        changed = [file for file, info in remote.items() if manifest.get(file) != info]
+        if changed == []:
+            print('No files changed since the last refresh!')
+            return
+
+        # A table is made of all the files of its layout, so all of them are reloaded
+        models = set(get_model(file) for file in changed)
+        files = [file for file in remote if get_model(file) in models]
+        tables = [self.layout_files[model]['table_name_db'] for model in models]
+        self.download_files([file for file in files if file in changed or not os.path.exists(file)])
+
+        self.get_engine()
+        live_schema, live_engine = self.schema, self.engine
+        shadow = f'{live_schema}_shadow'
+        self.engine.execute(f'DROP SCHEMA IF EXISTS {shadow} CASCADE')
+        self.engine.execute(f'CREATE SCHEMA {shadow}')
+        try:
+            self.schema = shadow
+            self.engine = None
+            self.get_engine()
+            self.uploaded = [file for file in remote if file not in files]
+            self.upload_to_postgresql(first_upload_truncate=True, workers=workers, loader=loader, partitioned=partitioned)
+            if any(file not in self.uploaded for file in files):
+                print('Refresh aborted, some files were not loaded. The live schema was not changed.')
+                return
+            self.index_db(tables=tables)
+        finally:
+            self.engine.dispose()
+            self.schema, self.engine = live_schema, live_engine
+
+        # Swap tables, partitions don't follow their parent table so they are moved too
+        with self.engine.begin() as conn:
+            for table in tables:
+                partitions = [r[0] for r in conn.execute(f"SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = '{shadow}.{table}'::regclass")]
+                conn.execute(f'DROP TABLE IF EXISTS {live_schema}.{table} CASCADE')
+                conn.execute(f'ALTER TABLE {shadow}.{table} SET SCHEMA {live_schema}')
+                for partition in partitions:
+                    conn.execute(f'ALTER TABLE {shadow}.{partition.split(".")[-1]} SET SCHEMA {live_schema}')
+        self.engine.execute(f'DROP SCHEMA {shadow} CASCADE')
+
+        for file in files:
+            manifest[file] = remote[file]
+        self.save_manifest(manifest)
+        print('Tables {} refreshed!'.format(', '.join(tables)))
+
+    def get_engine_url(self):
+        return f'postgresql://{self.user}:{self.password}@{self.serverip}/postgres?options=-csearch_path%3D{self.schema}'
+
+    def get_engine(self):
         if self.engine is None:
             # Create postgresql engine 
-            self.engine = create_engine(f'postgresql://{self.user}:{self.password}@{self.serverip}/postgres?options=-csearch_path%3D{self.schema}')
-
-        self.layout_files = {'EMPRESAS': {'columns':
-                                {'st_cnpj_base': [], 'st_razao_social': [], 'cd_natureza_juridica': [], 'cd_qualificacao': [],
-                                    'vl_capital_social': [], 'cd_porte_empresa': [], 'st_ente_federativo': []},
-                                'table_name_db': 'tb_empresa'},
-                        'ESTABELECIMENTOS': {'columns':
-                                    {'st_cnpj_base': [], 'st_cnpj_ordem': [], 'st_cnpj_dv': [], 'cd_matriz_filial': [], 'st_nome_fantasia': [], 'cd_situacao_cadastral': [],
-                                    'dt_situacao_cadastral': [], 'cd_motivo_situacao_cadastral': [], 'st_cidade_exterior': [], 'cd_pais': [], 'dt_inicio_atividade': [],
-                                    'cd_cnae_principal': [], 'cd_cnae_secundario': [], 'st_tipo_logradouro': [], 'st_logradouro': [], 'st_numero': [], 'st_complemento': [],
-                                    'st_bairro': [], 'st_cep': [], 'st_uf': [], 'cd_municipio': [], 'st_ddd1': [], 'st_telefone1': [], 'st_ddd2': [], 'st_telefone2': [],
-                                    'st_ddd_fax': [], 'st_fax': [], 'st_email': [], 'st_situacao_especial': [], 'dt_situacao_especial': []
-                                    }, 'table_name_db': 'tb_estabelecimento'},
-                        'SIMPLES': {'columns':
-                                    {'st_cnpj_base': [], 'st_opcao_simples': [], 'dt_opcao_simples': [], 'dt_exclusao_simples': [],
-                                    'st_opcao_mei': [], 'dt_opcao_mei': [], 'dt_exclusao_mei': []
-                                    }, 'table_name_db': 'tb_dados_simples'},
-                        'SOCIOS': {'columns':
-                                {'st_cnpj_base': [], 'cd_tipo': [], 'st_nome': [], 'st_cpf_cnpj': [], 'cd_qualificacao': [], 'dt_entrada': [],
-                                    'cd_pais': [], 'st_representante': [], 'st_nome_representante': [], 'cd_qualificacao_representante': [], 'cd_faixa_etaria': []},
-                                'table_name_db': 'tb_socio'},
-                        'PAISES': {'columns': {'cd_pais': [], 'st_pais': []}, 'table_name_db': 'tb_pais'},
-                        'MUNICIPIOS': {'columns': {'cd_municipio': [], 'st_municipio': []}, 'table_name_db': 'tb_municipios'},
-                        'QUALIFICACOES': {'columns': {'cd_qualificacao': [], 'st_qualificacao': []}, 'table_name_db': 'tb_qualificacao_socio'},
-                        'NATUREZAS': {'columns': {'cd_natureza_juridica': [], 'st_natureza_juridica': []}, 'table_name_db': 'tb_natureza_juridica'},
-                        'MOTIVOS': {'columns': {'cd_motivo_situacao_cadastral': [], 'st_motivo_situacao_cadastral': []}, 'table_name_db': 'tb_motivo_situacao_cadastral'},
-                        'CNAES': {'columns': {'cd_cnae': [], 'st_cnae': []}, 'table_name_db': 'tb_cnae'}
-                        }
+            from sqlalchemy import create_engine
+            self.engine = create_engine(self.get_engine_url())
+        return self.engine
 
-        for _ , row in self.df.iterrows():
-            # Check loaded files
-            if row.Name in self.uploaded:
-                continue
+    def prepare_upload(self, first_upload_truncate = False, partitioned = False):
+        # Returns the files still to be loaded, creating their tables if first_upload_truncate
+        self.get_engine()
 
-            if first_upload_truncate:
-                r = self.create_table(row.Name)
+        create_checkpoint_table(self.engine)
+
+        # Check loaded files
+        files = [row.Name for _ , row in self.df.iterrows() if row.Name not in self.uploaded]
+
+        if first_upload_truncate:
+            # Tables are created before the load, once per layout
+            for model in dict.fromkeys(get_model(file) for file in files):
+                r = self.create_table(model, partitioned)
                 if r != 'Exists':
                     print('Base {} Created!'.format(r))
 
-            temp_file = io.BytesIO()
-            # Select layout from filename
-            model = ''.join(letter for letter in row.Name.split('.')[0] if letter.isalpha()).upper()
-            # Unzip file into memory
-            with zipfile.ZipFile(row.Name, 'r') as zip_ref:
-                temp_file.write(zip_ref.read(zip_ref.namelist()[0]))
+        return files
+
+    def upload_file(self, file, streaming = True, loader = 'pandas'):
+        if loader == 'elt':
+            upload_zip_file_elt(self.engine, file, self.layout_files[get_model(file)], self.metrics)
+        else:
+            upload_zip_file(self.engine, file, self.layout_files[get_model(file)], streaming, self.metrics, 'binary' if loader == 'binary' else 'csv')
+        # Store processed filenames
+        print(f'File {file} uploaded!')
+        self.uploaded.append(file)
+        self.export_metrics()
+
+    def export_metrics(self):
+        if self.prometheus_file is not None:
+            self.metrics.write_prometheus(self.prometheus_file)
+
+    def download_and_upload(self, first_upload_truncate = False, download_workers = 3, max_local_files = 4, delete_loaded = True,
+                            loader = 'pandas', partitioned = False):
+        # Pipelined download and load: up to download_workers files are downloaded at the same time and each file
+        # is loaded as soon as it lands, while the next ones are still downloading
+        # max_local_files: zips on disk at the same time (downloading or waiting to be loaded), bounds the disk used
+        # delete_loaded = True: zips are deleted once loaded
+        files = self.prepare_upload(first_upload_truncate, partitioned)
+        slots = threading.Semaphore(max_local_files)
+        downloaded = queue.Queue()
+
+        def fetch(file):
+            slots.acquire()
+            try:
+                if not os.path.exists(file):
+                    self.download_file(self.url_base + file, os.path.join(os.getcwd(), file), progress_bar=False)
+                downloaded.put((file, None))
+            except Exception as e:
+                slots.release()
+                downloaded.put((file, e))
+
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            for file in files:
+                executor.submit(fetch, file)
 
-            # Indicator back to zero
-            temp_file.seek(0)
+            for _ in files:
+                file, error = downloaded.get()
+                if error is not None:
+                    print(f'File {file} download failed: {error}')
+                    continue
 
-            # Read csv's
-            for chunk in pd.read_csv(temp_file, delimiter=';', header=None, chunksize=65000, names=list(self.layout_files[model]['columns'].keys()), iterator=True, dtype=str, encoding="ISO-8859-1"):
-                # Format date columns
-                for i in chunk.columns[chunk.columns.str.contains('dt_')]:
-                    chunk.loc[chunk[i] == '00000000', i] = None
-                    chunk.loc[chunk[i] == '0', i] = None
-                    chunk[i] = pd.to_datetime(chunk[i], format='%Y%m%d', errors='coerce')
+                try:
+                    self.upload_file(file, loader=loader)
+                    if delete_loaded:
+                        os.remove(file)
+                except Exception as e:
+                    # Zip is kept, so the next call doesn't download it again
+                    print(f'File {file} failed: {e}')
+                finally:
+                    slots.release()
+
+    def upload_to_postgresql(self, first_upload_truncate = False, streaming = True, workers = 1, loader = 'pandas', partitioned = False):
+        # workers > 1: load the files in parallel, each worker process takes a whole file and COPY it
+        # over its own connection (ESTABELECIMENTOS, SOCIOS and EMPRESAS are already split in 10 files each)
+        # loader = 'pandas': rows are parsed and formatted in chunks by pandas before the COPY
+        # loader = 'binary': same as pandas, but chunks are sent with binary COPY (less parsing on both sides)
+        # loader = 'elt': raw COPY into an UNLOGGED staging table, formatting is done by Postgres (much less CPU on this side)
+        files = self.prepare_upload(first_upload_truncate, partitioned)
 
-                chunk.fillna('', inplace = True)
+        if workers <= 1:
+            for file in files:
+                self.upload_file(file, streaming, loader)
+            return
 
-                # Using Try for connection attempts, if the connection is lost, wait 60 seconds to retry
+        # Biggest files first, so the small ones fill the gaps at the end
+        files.sort(key=os.path.getsize, reverse=True)
+        stats = {}
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_upload_worker, initargs=(self.get_engine_url(),)) as executor:
+            futures = {executor.submit(upload_worker, file, self.layout_files[get_model(file)], streaming, loader, self.metrics.log_file): file for file in files}
+            for future in as_completed(futures):
                 try:
-                    chunk.to_sql(self.layout_files[model]['table_name_db'], self.engine, if_exists="append", index=False, method= DB_CNPJ.psql_insert_copy)
-                except:
-                    time.sleep(60)
-                    chunk.to_sql(self.layout_files[model]['table_name_db'], self.engine, if_exists="append", index=False, method= DB_CNPJ.psql_insert_copy)
+                    file, pid, rows, seconds, totals = future.result()
+                except Exception as e:
+                    # File is not marked as uploaded, so the next call tries it again
+                    print(f'File {futures[future]} failed: {e}')
+                    continue
+
+                self.metrics.merge(totals)
+                self.export_metrics()
+
+                # Store processed filenames
+                print(f'File {file} uploaded! {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s) by worker {pid}')
+                self.uploaded.append(file)
+                worker = stats.setdefault(pid, {'files': 0, 'rows': 0, 'seconds': 0.0})
+                worker['files'] += 1
+                worker['rows'] += rows
+                worker['seconds'] += seconds
 
-            # Store processed filenames
-            print(f'File {row.Name} uploaded!')
-            self.uploaded.append(row.Name)
+        for pid, worker in stats.items():
+            print(f'Worker {pid}: {worker["files"]} files, {worker["rows"]} rows, {worker["rows"] / max(worker["seconds"], 1e-9):.0f} rows/s')
+
+    def upload_to_parquet(self, folder = 'parquet', files = []):
+        # Write the zip files as parquet, with the same layout used in Postgres, to be queried locally (DuckDB, Arrow, pandas...)
+        # Tables are written in folder/<table_name_db>, tb_estabelecimento partitioned by UF
+        if files == []:
+            files = self.df.Name.values
 
-    def create_table(self, file):
-        file = file.split('.')[0]
-        file = ''.join(letter for letter in file if letter.isalpha()).upper()
+        for file in files:
+            layout = self.layout_files[get_model(file)]
+            # Old files of this zip are replaced
+            for root, _, names in os.walk(os.path.join(folder, layout['table_name_db'])):
+                if file.split('.')[0].lower() + '.parquet' in names:
+                    os.remove(os.path.join(root, file.split('.')[0].lower() + '.parquet'))
+            rows = write_zip_file_parquet(file, layout, folder)
+            print(f'File {file} written to parquet! {rows} rows')
+
+    def create_table(self, file, partitioned = False):
+        # partitioned = True: tables with 'partition_by' in the layout are partitioned by list of UF
+        file = get_model(file)
 
         for i in self.uploaded:
             if i.upper().find(file) >= 0:
                 return 'Exists'
 
-        df = pd.DataFrame(self.layout_files[file]['columns'], dtype=str)
-        df.to_sql(self.layout_files[file]['table_name_db'], self.engine, if_exists="replace", index=False)
-        return self.layout_files[file]['table_name_db']
-
-    def index_db(self):
-        # Create index to improve performance
-        indexes = ['CREATE INDEX ix_estab_cnpj_base ON cnpj.tb_estabelecimento USING hash(st_cnpj_base);',
-        'CREATE INDEX ix_estab_nome_fantasia ON cnpj.tb_estabelecimento USING hash(st_nome_fantasia);',
-        'CREATE INDEX ix_estab_uf ON cnpj.tb_estabelecimento USING hash(st_uf);',
-        'CREATE INDEX ix_estab_municipio ON cnpj.tb_estabelecimento USING hash(cd_municipio)',
-        'CREATE INDEX ix_muni_cod_municipio ON cnpj.tb_municipios USING hash(cd_municipio);',
-        'CREATE INDEX ix_muni_municipio ON cnpj.tb_municipios USING hash(st_municipio);',
-        'CREATE INDEX ix_simples_cnpj_base ON cnpj.tb_dados_simples USING hash(st_cnpj_base);',
-        'CREATE INDEX ix_empresa_cnpj_base ON cnpj.tb_empresa USING hash(st_cnpj_base);',
-        'CREATE INDEX ix_socio_cnpj_base ON cnpj.tb_socio USING hash(st_cnpj_base);',
-        'CREATE INDEX ix_empresa_razao_social ON cnpj.tb_empresa USING hash(st_razao_social);'
-        ]
-
-        for sql in indexes:
-            self.engine.execute(sql)
+        layout = self.layout_files[file]
+        table = layout['table_name_db']
+        columns = ', '.join(f'{c} {t}' for c, t in layout['columns'].items())
+        self.engine.execute(f'DROP TABLE IF EXISTS {table} CASCADE')
+        # Checkpoints of the old table are no longer valid
+        create_checkpoint_table(self.engine)
+        self.engine.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE st_table = '{table}'")
+        if partitioned and 'partition_by' in layout:
+            self.engine.execute(f'CREATE TABLE {table} ({columns}) PARTITION BY LIST ({layout["partition_by"]})')
+            for uf in UFS:
+                self.engine.execute(f"CREATE TABLE {table}_{uf.lower()} PARTITION OF {table} FOR VALUES IN ('{uf}')")
+            self.engine.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+        else:
+            self.engine.execute(f'CREATE TABLE {table} ({columns})')
+        return table
+
+    def build_indexes(self, indexes, maintenance_work_mem, concurrently, trgm_schema):
+        # Build a list of indexes one after another on its own connection
+        conn = self.engine.raw_connection()
+        try:
+            # CREATE INDEX CONCURRENTLY can't run inside a transaction
+            conn.connection.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"SET maintenance_work_mem = '{maintenance_work_mem}'")
+                for index in indexes:
+                    if index['method'] == 'gin_trgm':
+                        columns = ', '.join(f'{c} {trgm_schema}.gin_trgm_ops' for c in index['columns'])
+                    else:
+                        columns = ', '.join(index['columns'])
+                    start = time.time()
+                    cur.execute('CREATE INDEX {}{} ON {}.{} USING {} ({})'.format('CONCURRENTLY ' if concurrently else '', index['name'], self.schema,
+                                                                                index['table'], 'gin' if index['method'] == 'gin_trgm' else index['method'], columns))
+                    print(f'Index {index["name"]} created in {time.time() - start:.0f}s!')
+        finally:
+            conn.connection.autocommit = False
+            conn.close()
+
+    def index_db(self, tables = None, plan = None, workers = 4, maintenance_work_mem = '1GB', concurrently = False):
+        # Create index to improve performance, following INDEX_PLAN (or plan)
+        # Indexes that already exist are skipped and up to workers tables are indexed at the same time,
+        # so the memory used by Postgres can reach workers * maintenance_work_mem
+        # tables: only create the indexes of these tables (all by default)
+        # concurrently = True: don't block writes on tables in use (slower, not supported on partitioned tables)
+        self.get_engine()
+
+        if plan is None:
+            plan = INDEX_PLAN
+
+        existing = [r[0] for r in self.engine.execute(f"SELECT indexname FROM pg_indexes WHERE schemaname = '{self.schema}'")]
+        plan = [index for index in plan if (tables is None or index['table'] in tables) and index['name'] not in existing]
+        if plan == []:
+            return
+
+        trgm_schema = None
+        if any(index['method'] == 'gin_trgm' for index in plan):
+            # Extension kept in public, so it isn't dropped with the shadow schema of refresh
+            self.engine.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public')
+            trgm_schema = self.engine.execute("SELECT extnamespace::regnamespace::text FROM pg_extension WHERE extname = 'pg_trgm'").scalar()
+
+        by_table = {}
+        for index in plan:
+            by_table.setdefault(index['table'], []).append(index)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.build_indexes, indexes, maintenance_work_mem, concurrently, trgm_schema) for indexes in by_table.values()]
+            for future in as_completed(futures):
+                future.result()
 
     def show_files(self):
         print(self.df)
@@ -198,10 +1006,26 @@ if __name__ == '__main__':
 
     obj.show_files()
 
+    # For jobs that don't need the server (e.g. reindexing or reloading local zips)
+    # obj = DB_CNPJ(USER, PASSWORD, SERVER_IP, SCHEMA, offline=True)
+
     # For a single update file per file
     # Type the name of the file you want to download
     # obj.download_files(['Municipios.zip'])
 
+    # To write the files as parquet instead of loading them in Postgres
+    # obj.upload_to_parquet('parquet')
+
+    # To download and load at the same time, deleting each zip once loaded
+    # obj.download_and_upload(first_upload_truncate=True)
+
+    # For a monthly incremental refresh, only the changed files are downloaded and loaded, live tables are swapped at the end
+    # obj.refresh(workers=4)
+
+    # Per stage metrics as JSON lines and Prometheus textfile
+    # obj.metrics = LoadMetrics('cnpj_load.jsonl')
+    # obj.prometheus_file = 'cnpj_load.prom'
+
     obj.uploaded = []
     obj.upload_to_postgresql(first_upload_truncate=True)
 
@@ -0,0 +1,107 @@
+# SHARED HTTP CLIENT
+# One keep-alive session (connection pool) per host, limits of concurrent requests and requests per second
+# by host, and retries with exponential backoff and jitter for connection errors and 429/5xx answers.
+# Used by all the download scripts instead of bare requests.get / requests.head
+
+import time
+import random
+import threading
+from urllib import parse
+import requests
+from requests.adapters import HTTPAdapter
+
+header = {'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36'}
+
+# Answers worth trying again
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+# Connections kept open by host. Streamed bodies hold their connection after the semaphore is released,
+# so the pool is sized apart from concurrency
+POOL_SIZE = 32
+
+class Host:
+    def __init__(self, concurrency = 8, rate = None, pool_size = None):
+        # concurrency: requests in flight at the same time (for stream=True, until the headers arrive)
+        # rate: max requests per second, None for unlimited
+        # pool_size: connections kept open, at least concurrency (POOL_SIZE by default)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.next_request = 0
+        self.session = requests.Session()
+        self.session.headers.update(header)
+        self.pool_size = 0
+        self.reserve(pool_size if pool_size is not None else POOL_SIZE)
+
+    def reserve(self, connections):
+        # Grow the pool to at least connections (and concurrency), before the threads that use them start
+        with self.lock:
+            size = max(connections, self.concurrency)
+            if size <= self.pool_size:
+                return
+            self.pool_size = size
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+    def wait_rate(self):
+        if self.rate is None:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+hosts = {}
+hosts_lock = threading.Lock()
+
+def configure(host, concurrency = 8, rate = None, pool_size = None):
+    # Set the limits of a host (e.g. 'resultados.tse.jus.br'), must be called before its first request
+    with hosts_lock:
+        hosts[host] = Host(concurrency, rate, pool_size)
+
+def get_host(url):
+    host = parse.urlsplit(url).netloc
+    with hosts_lock:
+        if host not in hosts:
+            hosts[host] = Host()
+        return hosts[host]
+
+def reserve_connections(url, connections):
+    # For callers that stream from many threads at once (RangedDownloader), keeps the limits of the host
+    get_host(url).reserve(connections)
+
+def backoff_seconds(attempt, backoff, max_backoff):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+def request(method, url, retries = 5, backoff = 1.0, max_backoff = 60.0, timeout = 60, **kwargs):
+    # Same arguments of requests.request, plus the retry settings. The last answer (even 429/5xx) is returned,
+    # the last connection error is raised after all the retries
+    host = get_host(url)
+    for attempt in range(retries + 1):
+        wait = None
+        with host.semaphore:
+            host.wait_rate()
+            try:
+                r = host.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+            else:
+                if r.status_code not in RETRY_STATUS or attempt == retries:
+                    return r
+                # Server asks to wait
+                if r.headers.get('Retry-After', '').isdigit():
+                    wait = min(int(r.headers['Retry-After']), max_backoff)
+                r.close()
+        time.sleep(wait if wait is not None else backoff_seconds(attempt, backoff, max_backoff))
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def head(url, **kwargs):
+    return request('HEAD', url, **kwargs)
@@ -0,0 +1,117 @@
+# BATCHED LOOKUP OF CNPJ AGAINST THE TABLES LOADED BY get_cnpj_receita_federal.DB_CNPJ
+
+import re
+import time
+import threading
+from collections import OrderedDict
+import pandas as pd
+from sqlalchemy import create_engine
+
+# Dimension tables cached in memory: table -> (code column, name column)
+DIMENSIONS = {'tb_municipios': ('cd_municipio', 'st_municipio'),
+              'tb_cnae': ('cd_cnae', 'st_cnae'),
+              'tb_pais': ('cd_pais', 'st_pais'),
+              'tb_natureza_juridica': ('cd_natureza_juridica', 'st_natureza_juridica'),
+              'tb_qualificacao_socio': ('cd_qualificacao', 'st_qualificacao'),
+              'tb_motivo_situacao_cadastral': ('cd_motivo_situacao_cadastral', 'st_motivo_situacao_cadastral')}
+
+class CNPJ_Lookup:
+    def __init__(self, user, password, ip_postgres, schema, cache_size = 100000, ttl = 3600, batch_size = 10000):
+        # cache_size: CNPJs kept in the LRU cache
+        # ttl: seconds a cached CNPJ (or the dimension tables) is valid
+        # batch_size: CNPJs resolved per round trip
+        self.schema = schema
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.engine = create_engine(f'postgresql://{user}:{password}@{ip_postgres}/postgres?options=-csearch_path%3D{schema}')
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.dimensions = None
+        self.dimensions_expire = 0
+
+    def load_dimensions(self):
+        # Small tables, read whole into dicts code -> name
+        if self.dimensions is None or time.time() > self.dimensions_expire:
+            dimensions = {}
+            for table, (code, name) in DIMENSIONS.items():
+                df = pd.read_sql(f'SELECT {code}, {name} FROM {table}', self.engine)
+                dimensions[table] = dict(zip(df[code], df[name]))
+            self.dimensions = dimensions
+            self.dimensions_expire = time.time() + self.ttl
+        return self.dimensions
+
+    def query(self, cnpjs):
+        # Resolve a batch of CNPJs (14 digits) in one round trip per table
+        bases = [c[:8] for c in cnpjs]
+        params = {'bases': list(set(bases)), 'base': bases, 'ordem': [c[8:12] for c in cnpjs], 'dv': [c[12:] for c in cnpjs]}
+
+        # Join with the keys uses the composite index of tb_estabelecimento
+        estab = pd.read_sql('''SELECT e.* FROM tb_estabelecimento e
+                               JOIN unnest(%(base)s::char(8)[], %(ordem)s::char(4)[], %(dv)s::char(2)[]) AS k(st_cnpj_base, st_cnpj_ordem, st_cnpj_dv)
+                                 ON e.st_cnpj_base = k.st_cnpj_base AND e.st_cnpj_ordem = k.st_cnpj_ordem AND e.st_cnpj_dv = k.st_cnpj_dv''',
+                            self.engine, params=params)
+        empresa = pd.read_sql('SELECT * FROM tb_empresa WHERE st_cnpj_base = ANY(%(bases)s::char(8)[])', self.engine, params=params)
+        simples = pd.read_sql('SELECT * FROM tb_dados_simples WHERE st_cnpj_base = ANY(%(bases)s::char(8)[])', self.engine, params=params)
+        socio = pd.read_sql('SELECT * FROM tb_socio WHERE st_cnpj_base = ANY(%(bases)s::char(8)[])', self.engine, params=params)
+
+        empresa = {r['st_cnpj_base']: r for r in empresa.to_dict('records')}
+        simples = {r['st_cnpj_base']: r for r in simples.to_dict('records')}
+        socios = {}
+        for r in socio.to_dict('records'):
+            socios.setdefault(r['st_cnpj_base'], []).append(r)
+
+        dimensions = self.load_dimensions()
+        records = dict.fromkeys(cnpjs)
+        for r in estab.to_dict('records'):
+            record = dict(r)
+            record.update(empresa.get(r['st_cnpj_base'], {}))
+            record['st_municipio'] = dimensions['tb_municipios'].get(r['cd_municipio'])
+            record['st_cnae_principal'] = dimensions['tb_cnae'].get(r['cd_cnae_principal'])
+            record['st_pais'] = dimensions['tb_pais'].get(r['cd_pais'])
+            record['st_motivo_situacao_cadastral'] = dimensions['tb_motivo_situacao_cadastral'].get(r['cd_motivo_situacao_cadastral'])
+            record['st_natureza_juridica'] = dimensions['tb_natureza_juridica'].get(record.get('cd_natureza_juridica'))
+            record['simples'] = simples.get(r['st_cnpj_base'])
+            record['socios'] = [dict(s, st_qualificacao=dimensions['tb_qualificacao_socio'].get(s['cd_qualificacao']))
+                                for s in socios.get(r['st_cnpj_base'], [])]
+            records[r['st_cnpj_base'] + r['st_cnpj_ordem'] + r['st_cnpj_dv']] = record
+
+        return records
+
+    def lookup(self, cnpjs):
+        # Returns {cnpj: record}, record is None for CNPJs not found
+        # CNPJs can be formatted (00.000.000/0001-91), lose leading zeros or be alphanumeric (12.ABC.345/01DE-35)
+        cnpjs = [re.sub(r'[^0-9A-Za-z]', '', str(c)).upper().zfill(14) for c in cnpjs]
+        result = {}
+        missing = []
+        now = time.time()
+        with self.lock:
+            for cnpj in dict.fromkeys(cnpjs):
+                if cnpj in self.cache and self.cache[cnpj][0] > now:
+                    self.cache.move_to_end(cnpj)
+                    result[cnpj] = self.cache[cnpj][1]
+                else:
+                    missing.append(cnpj)
+
+        for i in range(0, len(missing), self.batch_size):
+            records = self.query(missing[i:i + self.batch_size])
+            with self.lock:
+                for cnpj, record in records.items():
+                    self.cache[cnpj] = (time.time() + self.ttl, record)
+                    self.cache.move_to_end(cnpj)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            result.update(records)
+
+        return result
+
+
+if __name__ == '__main__':
+    # Set Global Variables
+    USER = 'username'
+    PASSWORD = 'password'
+    SERVER_IP = 'server_ip:server_port' # Server IP + Port
+    SCHEMA = 'cnpj'
+    obj = CNPJ_Lookup(USER, PASSWORD, SERVER_IP, SCHEMA)
+
+    print(obj.lookup(['00.000.000/0001-91', '33000167000101']))
@@ -0,0 +1,103 @@
+# LOCAL HTTP SERVER WITH BYTE RANGES AND BANDWIDTH LIMITS
+# Serves a file limiting the speed of each connection and the total speed of the server, to test
+# RangedDownloader (download_acelerator.py) against servers like the slow government ones
+
+import os
+import re
+import time
+import threading
+import http.server
+
+class Bandwidth:
+	# Token bucket shared by all connections, bytes_per_second = None means unlimited
+	def __init__(self, bytes_per_second):
+		self.bytes_per_second = bytes_per_second
+		self.available = 0
+		self.last = time.time()
+		self.lock = threading.Lock()
+
+	def take(self, n):
+		if self.bytes_per_second is None:
+			return
+		while True:
+			with self.lock:
+				now = time.time()
+				# Bursts limited to 0.1 second of bandwidth
+				self.available = min(self.available + (now - self.last) * self.bytes_per_second, max(self.bytes_per_second / 10, 64 * 1024))
+				self.last = now
+				if self.available >= n:
+					self.available -= n
+					return
+				wait = (n - self.available) / self.bytes_per_second
+			time.sleep(wait)
+
+def make_handler(path, conn_bytes_per_second, total):
+	size = os.path.getsize(path)
+
+	class RangeHandler(http.server.BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+
+		def log_message(self, *args):
+			pass
+
+		def do_HEAD(self):
+			self.send_response(200)
+			self.send_header('Content-Length', str(size))
+			self.send_header('Accept-Ranges', 'bytes')
+			self.end_headers()
+
+		def do_GET(self):
+			start, end = 0, size - 1
+			m = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+			if m:
+				start = int(m.group(1))
+				end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+				self.send_response(206)
+				self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+			else:
+				self.send_response(200)
+			self.send_header('Content-Length', str(end - start + 1))
+			self.end_headers()
+
+			block = 64 * 1024
+			with open(path, 'rb') as f:
+				f.seek(start)
+				pos = start
+				try:
+					while pos <= end:
+						data = f.read(min(block, end - pos + 1))
+						total.take(len(data))
+						begin = time.time()
+						self.wfile.write(data)
+						pos += len(data)
+						# Per connection limit
+						if conn_bytes_per_second is not None:
+							time.sleep(max(len(data) / conn_bytes_per_second - (time.time() - begin), 0))
+				except (BrokenPipeError, ConnectionResetError):
+					pass
+
+	return RangeHandler
+
+def serve(path, port = 8000, conn_bytes_per_second = None, total_bytes_per_second = None):
+	# Returns the running server (in a background thread), stop it with server.shutdown()
+	handler = make_handler(path, conn_bytes_per_second, Bandwidth(total_bytes_per_second))
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+if __name__ == '__main__':
+	from download_acelerator import RangedDownloader
+
+	# 100 MB file, 1 MB/s per connection and 6 MB/s in total: the best is about 6 connections
+	with open('range_test.bin', 'wb') as f:
+		f.write(os.urandom(100 * 1024 * 1024))
+	server = serve('range_test.bin', 8000, conn_bytes_per_second=1024 * 1024, total_bytes_per_second=6 * 1024 * 1024)
+
+	RangedDownloader('http://127.0.0.1:8000/range_test.bin', 'range_test_download.bin', conns=2, adaptive=True).download()
+	server.shutdown()
+	with open('range_test.bin', 'rb') as a, open('range_test_download.bin', 'rb') as b:
+		print('Files match:', a.read() == b.read())
+	os.remove('range_test.bin')
+	os.remove('range_test_download.bin')
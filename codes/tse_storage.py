@@ -0,0 +1,173 @@
+# STORAGE OF THE TSE 2022 FILES DOWNLOADED BY download_tse_2022.py
+# Files are addressed by the key of their section (cd_uf, cd_municipio, cd_zona, cd_secao) and their name.
+# FolderStorage: one file per artifact under folder/<uf>/ (the original layout)
+# PackStorage: artifacts appended to uncompressed tar shards per UF, with an index from section and file name to offset,
+# for millions of small files without millions of inodes
+# Both have put(key, nm_file, chunks), get(key, nm_file), size(key, nm_file) and hash(key, nm_file)
+
+import os
+import time
+import hashlib
+import sqlite3
+import tarfile
+import threading
+
+def hash_bytes(data):
+    return len(data), hashlib.sha256(data).hexdigest()
+
+def hash_file(path):
+    # Size and sha256 of a local file, None when it doesn't exist
+    if not os.path.exists(path):
+        return None
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(block)
+            size += len(block)
+    return size, sha256.hexdigest()
+
+class FolderStorage:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, key, nm_file):
+        return os.path.join(self.folder, key[0], nm_file)
+
+    def put(self, key, nm_file, chunks):
+        # Streamed to path + '.part' and renamed at the end, so an interrupted download never looks complete
+        path = self.path(key, nm_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path + '.part', 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+        except Exception:
+            os.remove(path + '.part')
+            raise
+        os.replace(path + '.part', path)
+
+    def get(self, key, nm_file):
+        path = self.path(key, nm_file)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def size(self, key, nm_file):
+        path = self.path(key, nm_file)
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    def hash(self, key, nm_file):
+        return hash_file(self.path(key, nm_file))
+
+class PackStorage:
+    # Shards are folder/<uf>-00000.tar, folder/<uf>-00001.tar ... of about max_shard_bytes each, written append only.
+    # The index (folder/index.sqlite) is the truth: a member is only visible after its index row is committed, and on
+    # opening a shard the bytes after its last indexed member (a write cut by a crash) are dropped, so the shards stay valid tars.
+    # Safe for the threads of one process (the crawler), other processes (the log decoder) can read at the same time
+    INDEX_TABLES = '''
+    CREATE TABLE IF NOT EXISTS tb_pack (cd_uf TEXT, cd_municipio TEXT, cd_zona TEXT, cd_secao TEXT, nm_arquivo TEXT,
+                                        nm_pack TEXT, nr_offset INTEGER, nr_bytes INTEGER,
+                                        PRIMARY KEY (cd_uf, cd_municipio, cd_zona, cd_secao, nm_arquivo));
+    '''
+
+    def __init__(self, folder, max_shard_bytes = 1024 * 1024 * 1024):
+        self.folder = folder
+        self.max_shard_bytes = max_shard_bytes
+        os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(folder, 'index.sqlite'), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.INDEX_TABLES)
+        # lock: index connection, uf_locks: appends to the shards of each UF
+        self.lock = threading.Lock()
+        self.uf_locks = {}
+        self.shards = {}
+
+    def __getstate__(self):
+        # Sent to worker processes without the connection, locks and open shards
+        return {'folder': self.folder, 'max_shard_bytes': self.max_shard_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['folder'], state['max_shard_bytes'])
+
+    def uf_lock(self, cd_uf):
+        with self.lock:
+            return self.uf_locks.setdefault(cd_uf, threading.Lock())
+
+    def indexed_end(self, nm_pack):
+        # End of the last indexed member of a shard, rounded to the tar block
+        with self.lock:
+            end, = self.conn.execute('SELECT MAX(nr_offset + nr_bytes) FROM tb_pack WHERE nm_pack = ?', (nm_pack,)).fetchone()
+        return 0 if end is None else end + (-end % tarfile.BLOCKSIZE)
+
+    def shard(self, cd_uf):
+        # Open shard of the UF (called with its uf_lock held), a new one when it is full
+        if cd_uf not in self.shards:
+            packs = sorted(f for f in os.listdir(self.folder) if f.startswith(cd_uf + '-') and f.endswith('.tar'))
+            nm_pack = packs[-1] if packs else f'{cd_uf}-00000.tar'
+            file = open(os.path.join(self.folder, nm_pack), 'ab')
+            file.truncate(self.indexed_end(nm_pack))
+            file.seek(0, os.SEEK_END)
+            self.shards[cd_uf] = (nm_pack, file)
+
+        nm_pack, file = self.shards[cd_uf]
+        if file.tell() >= self.max_shard_bytes:
+            file.close()
+            n = int(nm_pack[len(cd_uf) + 1:-4]) + 1
+            nm_pack = f'{cd_uf}-{n:05d}.tar'
+            file = open(os.path.join(self.folder, nm_pack), 'ab')
+            self.shards[cd_uf] = (nm_pack, file)
+        return nm_pack, file
+
+    def put(self, key, nm_file, chunks):
+        # Files are small, read whole before anything is written, so a failed download leaves nothing behind
+        data = b''.join(chunks)
+        info = tarfile.TarInfo('/'.join((*key[1:], nm_file)))
+        info.size = len(data)
+        info.mtime = int(time.time())
+        header = info.tobuf(tarfile.GNU_FORMAT)
+        with self.uf_lock(key[0]):
+            nm_pack, file = self.shard(key[0])
+            offset = file.tell() + len(header)
+            file.write(header + data + b'\0' * (-len(data) % tarfile.BLOCKSIZE))
+            file.flush()
+            # A file downloaded again is appended again, the index points to the last copy
+            with self.lock, self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO tb_pack VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (*key, nm_file, nm_pack, offset, len(data)))
+
+    def member(self, key, nm_file):
+        # Shard, offset and size of the last copy of a file, None when it isn't indexed
+        with self.lock:
+            return self.conn.execute('SELECT nm_pack, nr_offset, nr_bytes FROM tb_pack WHERE cd_uf = ? AND cd_municipio = ? AND cd_zona = ? AND cd_secao = ? AND nm_arquivo = ?',
+                                     (*key, nm_file)).fetchone()
+
+    def get(self, key, nm_file):
+        row = self.member(key, nm_file)
+        if row is None:
+            return None
+        nm_pack, offset, size = row
+        with open(os.path.join(self.folder, nm_pack), 'rb') as file:
+            file.seek(offset)
+            data = file.read(size)
+        return data if len(data) == size else None
+
+    def size(self, key, nm_file):
+        # From the index, the member must also be inside its shard
+        row = self.member(key, nm_file)
+        if row is None:
+            return None
+        nm_pack, offset, size = row
+        path = os.path.join(self.folder, nm_pack)
+        return size if os.path.exists(path) and os.path.getsize(path) >= offset + size else None
+
+    def hash(self, key, nm_file):
+        data = self.get(key, nm_file)
+        return None if data is None else hash_bytes(data)
+
+    def close(self):
+        for nm_pack, file in self.shards.values():
+            file.close()
+        self.shards = {}
+        self.conn.close()